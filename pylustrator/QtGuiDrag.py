@@ -35,10 +35,11 @@ from matplotlib.axes import Axes
 import matplotlib.transforms as transforms
 
 from .drag_bib import FigureDragger
-from .helper_functions import changeFigureSize
+from .helper_functions import changeFigureSize, getEntryPoint
 from .drag_bib import getReference
+from .change_tracker import ChangeRecord, save_queue
 
-from .drag_helper import DragManager
+from .drag_helper import DragManager, MotionCoalescer
 
 import sys
 
@@ -53,18 +54,23 @@ sys.excepthook = my_excepthook
 figures = {}
 app = None
 keys_for_lines = {}
+guide_options = {}
 
 
-def initialize():
-    global app, keys_for_lines
+def initialize(grid=None, xguides=None, yguides=None, unit="cm"):
+    """ start pylustrator, optionally with a grid (its spacing) and guide lines (their positions) to snap to
+
+    The grid and the guides are given in the unit "cm", "inch" or in figure coordinates, negative guide positions are
+    measured from the right or top edge of the figure.
+    """
+    global app, keys_for_lines, guide_options
+    guide_options = dict(grid=grid, xguides=xguides, yguides=yguides, unit=unit)
     if app is None:
         app = QtWidgets.QApplication(sys.argv)
     plt.show = show
     plt.figure = figure
 
-    import traceback
-    stack_call_position = traceback.extract_stack()[-2]
-    stack_call_position.filename
+    stack_call_position = getEntryPoint()
 
     from matplotlib.axes._axes import Axes
     from matplotlib.figure import Figure
@@ -78,11 +84,9 @@ def initialize():
                     key = 'fig.axes[%d].texts[%d].new' % (index, len(axes.texts))
                     if plt.gca().get_label():
                         key = 'fig.ax_dict["%s"].texts[%d].new' % (plt.gca().get_label(), len(axes.texts))
-                stack = traceback.extract_stack()
-                for stack_item in stack:
-                    if stack_item.filename == stack_call_position.filename:
-                        keys_for_lines[stack_item.lineno] = key
-                        break
+                call_position = getEntryPoint()
+                if call_position.filename == stack_call_position.filename:
+                    keys_for_lines[call_position.lineno] = key
             return func(axes, *args, **kwargs)
 
         return f
@@ -99,7 +103,16 @@ def initialize():
 
     def savefig(self, filename, *args, **kwargs):
         self._last_saved_figure = filename
-        sf(self, filename, *args, **kwargs)
+        # the guides, snap lines, outlines and grabbers of pylustrator should not be part of the exported image
+        hidden = [artist for artist in self.get_children()
+                  if artist.get_label() in ("_tmp_snap", "grabber") and artist.get_visible()]
+        for artist in hidden:
+            artist.set_visible(False)
+        try:
+            sf(self, filename, *args, **kwargs)
+        finally:
+            for artist in hidden:
+                artist.set_visible(True)
 
     Figure.savefig = savefig
 
@@ -119,7 +132,7 @@ def show():
         warnAboutTicks(window.fig)
         # add dragger
         # FigureDragger(_pylab_helpers.Gcf.figs[figure].canvas.figure, [], [], "cm")
-        DragManager(_pylab_helpers.Gcf.figs[figure].canvas.figure)
+        DragManager(_pylab_helpers.Gcf.figs[figure].canvas.figure, **guide_options)
         window.update()
         # and show it
         window.show()
@@ -199,11 +212,11 @@ class Linkable:
 
             self.setLinkedProperty = set
             self.getLinkedProperty = get
-            self.serializeLinkedProperty = lambda x: "." + property_name + " = %s" % x
+            self.serializeLinkedProperty = lambda *args: ChangeRecord("." + property_name, args, assign=True, float_format="%s")
         else:
             self.setLinkedProperty = lambda text: getattr(self.element, "set_" + property_name)(text)
             self.getLinkedProperty = lambda: getattr(self.element, "get_" + property_name)()
-            self.serializeLinkedProperty = lambda x: ".set_" + property_name + "(%s)" % x
+            self.serializeLinkedProperty = lambda *args: ChangeRecord(".set_" + property_name, args, float_format="%s")
 
         if condition is None:
             self.condition = lambda x: True
@@ -232,7 +245,7 @@ class Linkable:
             fig = self.element
         else:
             fig = self.element.figure
-        fig.change_tracker.addChange(self.element, self.serializeLinkedProperty(self.getSerialized()))
+        fig.change_tracker.addChange(self.element, self.serializeLinkedProperty(*self.getSerialized()))
         fig.canvas.draw()
 
     def set(self, value):
@@ -242,7 +255,7 @@ class Linkable:
         return None
 
     def getSerialized(self):
-        return ""
+        return ()
 
 
 class DimensionsWidget(QtWidgets.QWidget, Linkable):
@@ -315,7 +328,7 @@ class DimensionsWidget(QtWidgets.QWidget, Linkable):
         self.setValue(value)
 
     def getSerialized(self):
-        return ", ".join([str(i) for i in self.get()])
+        return tuple(self.get())
 
 
 class TextWidget(QtWidgets.QWidget, Linkable):
@@ -372,7 +385,7 @@ class TextWidget(QtWidgets.QWidget, Linkable):
         self.setText(value)
 
     def getSerialized(self):
-        return "\"" + str(self.get()) + "\""
+        return (self.get(),)
 
 
 class NumberWidget(QtWidgets.QWidget, Linkable):
@@ -420,7 +433,7 @@ class NumberWidget(QtWidgets.QWidget, Linkable):
         self.setValue(value)
 
     def getSerialized(self):
-        return self.get()
+        return (self.get(),)
 
 
 class ComboWidget(QtWidgets.QWidget, Linkable):
@@ -468,7 +481,7 @@ class ComboWidget(QtWidgets.QWidget, Linkable):
         self.setText(value)
 
     def getSerialized(self):
-        return "\"" + str(self.get()) + "\""
+        return (self.get(),)
 
 
 class CheckWidget(QtWidgets.QWidget):
@@ -634,7 +647,7 @@ class QColorWidget(QtWidgets.QWidget, Linkable):
             self.setColor(None)
 
     def getSerialized(self):
-        return "\"" + self.color + "\""
+        return (self.color,)
 
 
 class TextPropertiesWidget(QtWidgets.QWidget):
@@ -1801,6 +1814,7 @@ class InfoDialog(QtWidgets.QWidget):
 
 class PlotWindow(QtWidgets.QWidget):
     fitted_to_view = False
+    save_finished = QtCore.Signal(object)
 
     def __init__(self, number, size, *args, **kwargs):
         QtWidgets.QWidget.__init__(self)
@@ -1908,7 +1922,9 @@ class PlotWindow(QtWidgets.QWidget):
         self.control_modifier = False
 
         self.fig.canvas.mpl_connect('button_press_event', self.button_press_event)
-        self.fig.canvas.mpl_connect('motion_notify_event', self.mouse_move_event)
+        # only process the latest mouse position if the events come faster than they can be processed
+        self.motion = MotionCoalescer(self.fig.canvas, self.mouse_move_event)
+        self.fig.canvas.mpl_connect('motion_notify_event', self.motion.put)
         self.fig.canvas.mpl_connect('button_release_event', self.button_release_event)
         self.drag = None
 
@@ -1923,12 +1939,23 @@ class PlotWindow(QtWidgets.QWidget):
         self.footer_label2 = QtWidgets.QLabel("")
         self.footer_layout.addWidget(self.footer_label2)
 
+        # the script is written in a background thread, the result is passed back to the gui thread by a signal
+        self.save_finished.connect(self.showSaveResult)
+
         # self.layout_plot.addStretch()
         # self.layout_main.addStretch()
 
     def actionSave(self):
         self.fig.change_tracker.save()
-        if getattr(self.fig, "_last_saved_figure"):
+
+    def saveFinished(self, error):
+        # called from the save thread
+        self.save_finished.emit(error)
+
+    def showSaveResult(self, error):
+        self.updateTitle(error)
+        # export the figure again, only once for several saves that were written together
+        if error is None and getattr(self.fig, "_last_saved_figure", None):
             self.fig.savefig(self.fig._last_saved_figure)
 
     def actionSaveImage(self):
@@ -2071,6 +2098,7 @@ class PlotWindow(QtWidgets.QWidget):
 
     def button_release_event(self, event):
         if event.button == 2:
+            self.motion.flush()
             self.drag = None
 
     def canvas_key_press(self, event):
@@ -2196,15 +2224,30 @@ class PlotWindow(QtWidgets.QWidget):
 
         self.fig.change_tracker.addChange = wrap(self.fig.change_tracker.addChange)
 
+        def wrap(func):
+            def newfunc(callback=None):
+                # all saves (the menu, ctrl+s in the canvas, closing the window) report their result in the title
+                result = func(self.saveFinished if callback is None else callback)
+                self.updateTitle()
+                return result
+
+            return newfunc
+
         self.fig.change_tracker.save = wrap(self.fig.change_tracker.save)
 
         self.treeView.setCurrentIndex(self.fig)
 
-    def updateTitle(self):
+    def updateTitle(self, error=False):
         if self.fig.change_tracker.saved:
-            self.setWindowTitle("Figure %s - Pylustrator" % self.fig.number)
+            title = "Figure %s - Pylustrator" % self.fig.number
         else:
-            self.setWindowTitle("Figure %s* - Pylustrator" % self.fig.number)
+            title = "Figure %s* - Pylustrator" % self.fig.number
+        # report the result of the last save
+        if error is None and self.fig.change_tracker.saved:
+            title += " (saved)"
+        elif error:
+            title += " (saving failed: %s)" % error
+        self.setWindowTitle(title)
 
     def select_element(self, element):
         if element is None:
@@ -2225,3 +2268,10 @@ class PlotWindow(QtWidgets.QWidget):
                 event.ignore()
             if reply == QtWidgets.QMessageBox.Yes:
                 self.fig.change_tracker.save()
+                # wait for the file to be written before the window closes
+                save_queue.flush()
+            if reply == QtWidgets.QMessageBox.No:
+                # the discarded changes should not be restored at the next start
+                self.fig.change_tracker.discardJournal()
+        if event.isAccepted():
+            self.fig.change_tracker.close()
@@ -21,18 +21,32 @@
 
 from __future__ import division, print_function
 
+import ast
+import atexit
+import numbers
+import os
 import re
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
 import traceback
+import zlib
 
 import matplotlib
+import matplotlib.pyplot
+import numpy as np
 from matplotlib.axes import Axes
+from matplotlib.backend_bases import TimerBase
 from matplotlib.figure import Figure
 from matplotlib.lines import Line2D
 from matplotlib.patches import Rectangle
 from matplotlib.text import Text
 from natsort import natsorted
 
-from pylustrator.helper_functions import main_figure
+from pylustrator.helper_functions import main_figure, getEntryPoint
 
 
 def getReference(element):
@@ -77,12 +91,231 @@ def getReference(element):
     raise (TypeError(str(type(element)) + " not found"))
 
 
+# the parts a reference path can consist of, in the order in which they can follow each other
+reference_parts = [
+    ("ax_dict", ".ax_dict[\"", "\"]"),
+    ("axes", ".axes[", "]"),
+    ("texts", ".texts[", "]"),
+    ("patches", ".patches[", "]"),
+    ("get_legend", ".get_legend(", ")"),
+]
+
+
+def splitReference(line):
+    """ parse the reference path at the start of a line of generated code (e.g. fig.ax_dict["a"].texts[1])
+
+    Returns the parts of the path as (name, argument, end) tuples and the position in the line where the path ends. If
+    the line does not start with a reference path, the parts are None.
+    """
+    if not line.startswith("fig"):
+        return None, 0
+    end = len("fig")
+    parts = []
+    for name, start, stop in reference_parts:
+        if not line.startswith(start, end):
+            continue
+        begin = end + len(start)
+        close = line.find(stop, begin)
+        if close == -1:
+            break
+        argument = line[begin:close]
+        if stop == "]":
+            if not argument.isdigit():
+                break
+            argument = int(argument)
+        end = close + len(stop)
+        parts.append((name, argument, end))
+    return parts, end
+
+
+def resolveReference(figure, path, parts, cache):
+    """ get the object of a reference path by walking the figure, the objects of all prefixes are cached """
+    try:
+        return cache[path]
+    except KeyError:
+        pass
+    if len(parts) == 0:
+        obj = figure
+    else:
+        name, argument, _ = parts[-1]
+        parent_end = parts[-2][2] if len(parts) > 1 else len("fig")
+        parent = resolveReference(figure, path[:parent_end], parts[:-1], cache)
+        if name == "ax_dict":
+            if "ax_dict" not in cache:
+                cache["ax_dict"] = {ax.get_label(): ax for ax in figure.axes}
+            obj = cache["ax_dict"][argument]
+        elif name == "axes":
+            obj = figure.axes[argument]
+        elif name == "get_legend":
+            obj = parent.get_legend()
+        else:
+            obj = getattr(parent, name)[argument]
+    cache[path] = obj
+    return obj
+
+
+def splitCommand(text):
+    """ split e.g. '.set_position([0.1, 0.2])' into the command '.set_position' and the parameters """
+    if not text.startswith("."):
+        return None, None
+    end = len(text)
+    for char in "(= ":
+        index = text.find(char)
+        if index != -1 and index < end:
+            end = index
+    return text[:end], text[end:]
+
+
+def getReferenceIndex(figure):
+    """ build a dictionary that maps every artist of the figure that can be referenced to its reference string """
+    index = {figure: "fig"}
+    for axes in figure.axes:
+        axes_reference = getReference(axes)
+        index[axes] = axes_reference
+        for i, line in enumerate(axes.lines):
+            index.setdefault(line, axes_reference + ".lines[%d]" % i)
+        for i, patch in enumerate(axes.patches):
+            index.setdefault(patch, axes_reference + ".patches[%d]" % i)
+        for i, text in enumerate(axes.texts):
+            index.setdefault(text, axes_reference + ".texts[%d]" % i)
+        legend = axes.get_legend()
+        if legend is not None:
+            index.setdefault(legend, axes_reference + ".get_legend()")
+    for i, patch in enumerate(figure.patches):
+        if not patch.axes:
+            index.setdefault(patch, "fig.patches[%d]" % i)
+    for i, text in enumerate(figure.texts):
+        index.setdefault(text, "fig.texts[%d]" % i)
+    # axis labels are only referenced through their axes if they are not in any of the text lists
+    for axes in figure.axes:
+        axes_reference = index[axes]
+        index.setdefault(axes.get_xaxis().get_label(), axes_reference + ".get_xaxis().get_label()")
+        index.setdefault(axes.get_yaxis().get_label(), axes_reference + ".get_yaxis().get_label()")
+    return index
+
+
+def formatValue(value, float_format="%f"):
+    """ convert a value to the python code that creates it """
+    if isinstance(value, str):
+        return "\"" + value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") + "\""
+    if isinstance(value, (bool, np.bool_)):
+        return str(bool(value))
+    if isinstance(value, numbers.Integral):
+        return "%d" % value
+    if isinstance(value, numbers.Real):
+        return float_format % value
+    if isinstance(value, tuple):
+        return "(" + ", ".join(formatValue(v, float_format) for v in value) + ("," if len(value) == 1 else "") + ")"
+    if isinstance(value, (list, np.ndarray)):
+        return "[" + ", ".join(formatValue(v, float_format) for v in value) + "]"
+    return repr(value)
+
+
+class ChangeRecord:
+    """ a change of an element stored as its command and arguments, the code is only generated when it is needed """
+
+    def __init__(self, command, args=(), kwargs=None, assign=False, float_format="%f"):
+        self.command = command
+        self.args = args
+        self.kwargs = kwargs
+        self.assign = assign
+        self.float_format = float_format
+
+    def __str__(self):
+        if self.assign:
+            return "%s = %s" % (self.command, formatValue(self.args[0], self.float_format))
+        parameters = [formatValue(arg, self.float_format) for arg in self.args]
+        if self.kwargs:
+            parameters += ["%s=%s" % (key, formatValue(value, self.float_format)) for key, value in self.kwargs.items()]
+        return "%s(%s)" % (self.command, ", ".join(parameters))
+
+
+def getElementPositions(figure, elements):
+    """ get the positions of the elements as one array of points in inches and the number of points of each element """
+    from pylustrator.snap import TargetWrapper
+    points = [np.asarray(TargetWrapper(element).get_positions(), dtype=float) for element in elements]
+    counts = np.array([len(p) for p in points], dtype=np.int32)
+    if len(points) == 0:
+        return counts, np.zeros((0, 2))
+    return counts, np.concatenate(points) / figure.dpi
+
+
+def setElementPositions(figure, elements, counts, points):
+    """ set the positions of the elements from an array obtained with getElementPositions """
+    from pylustrator.snap import TargetWrapper
+    points = np.split(np.asarray(points, dtype=float) * figure.dpi, np.cumsum(counts)[:-1])
+    for element, element_points in zip(elements, points):
+        TargetWrapper(element).set_positions(element_points)
+
+
+class Edit:
+    """ an undo step given by an undo and a redo function """
+    # the memory of closures can not be measured, restore functions can report it with a nbytes attribute
+    default_nbytes = 1024
+
+    def __init__(self, undo, redo, name=""):
+        self.undo = undo
+        self.redo = redo
+        self.name = name
+        self.nbytes = getattr(undo, "nbytes", self.default_nbytes) + getattr(redo, "nbytes", self.default_nbytes)
+
+
+class PositionEdit(Edit):
+    """ an undo step that only stores the positions of the changed elements before and after the edit
+
+    The points of all elements are stored in two compact arrays in inches, so they stay valid when the dpi changes.
+    """
+
+    def __init__(self, figure, elements, counts, before, after, name=""):
+        self.figure = figure
+        self.elements = tuple(elements)
+        self.counts = counts
+        self.before = before
+        self.after = after
+        self.name = name
+        self.nbytes = self.before.nbytes + self.after.nbytes + self.counts.nbytes + 8 * len(self.elements)
+
+    @staticmethod
+    def create(figure, elements, counts, before, after, name=""):
+        """ create an undo step for the elements whose positions changed, returns None if nothing changed """
+        ends = np.cumsum(counts)
+        changed = np.array([not np.array_equal(before[end - count:end], after[end - count:end])
+                            for count, end in zip(counts, ends)], dtype=bool)
+        if not np.any(changed):
+            return None
+        mask = np.repeat(changed, counts)
+        return PositionEdit(figure, [element for element, c in zip(elements, changed) if c], counts[changed],
+                            before[mask], after[mask], name)
+
+    def undo(self):
+        self.apply(self.before)
+
+    def redo(self):
+        self.apply(self.after)
+
+    def apply(self, points):
+        setElementPositions(self.figure, self.elements, self.counts, points)
+        # select the changed elements again
+        selection = getattr(self.figure, "selection", None)
+        if selection is not None:
+            selection.clear_targets()
+            for element in self.elements:
+                selection.add_target(element)
+
+
 class ChangeTracker:
     changes = None
     saved = True
+    reference_index = None
+    # the maximal memory in bytes used by the undo history, the oldest edits are dropped when it is exceeded
+    edits_memory_limit = 32 * 1024 * 1024
+    edits_memory = 0
+    # the unsaved changes are written to a journal at most journal_interval seconds after they were made
+    journal = None
+    journal_interval = 0.5
+    journal_timer = None
 
     def __init__(self, figure):
-        global stack_position
         self.figure = figure
         self.edits = []
         self.last_edit = -1
@@ -94,22 +327,74 @@ class ChangeTracker:
             axes.number = index
 
         # store the position where StartPylustrator was called
-        stack_position = traceback.extract_stack()[-4]
+        self.stack_position = getEntryPoint()
+        registerTracker(self)
+        # a closed figure should not be saved together with the other figures of the file anymore
+        self.figure.canvas.mpl_connect("close_event", lambda event: self.close())
 
         self.fig_inch_size = self.figure.get_size_inches()
 
         self.load()
+        self.openJournal()
 
     def addChange(self, command_obj, command, reference_obj=None, reference_command=None):
-        command = command.replace("\n", "\\n")
         if reference_obj is None:
             reference_obj = command_obj
-        if reference_command is None:
-            reference_command, = re.match(r"(\.[^(=]*)", command).groups()
+        if isinstance(command, ChangeRecord):
+            # structured changes are only converted to code when the changes are saved
+            if reference_command is None:
+                reference_command = command.command
+        else:
+            command = command.replace("\n", "\\n")
+            if reference_command is None:
+                reference_command = re.match(r"(\.[^(=]*)", command).group(1).strip()
         self.changes[reference_obj, reference_command] = (command_obj, command)
         self.saved = False
+        # the journal is written lazily, so that repeated changes of the same property result in one record
+        if self.journal is not None:
+            self.journal_dirty[reference_obj, reference_command] = True
+        # a new artist shifts the indices of the lists it is added to
+        if reference_command == ".new":
+            self.reference_index = None
+            self.flushJournal()
+        elif time.monotonic() - self.journal_time > self.journal_interval:
+            self.flushJournal()
+        elif self.journal is not None:
+            self.scheduleJournalFlush()
+
+    def scheduleJournalFlush(self):
+        """ write the journal journal_interval seconds after the first unwritten change, even if no change follows """
+        if self.journal_timer is not None:
+            return
+        timer = self.figure.canvas.new_timer(interval=int(self.journal_interval * 1000))
+        # canvases without an event loop have no working timer, then the journal is written directly
+        if type(timer) is TimerBase:
+            return self.flushJournal()
+        timer.single_shot = True
+        timer.add_callback(self.flushJournal)
+        self.journal_timer = timer
+        timer.start()
+
+    def get_reference(self, element):
+        """ get the reference string of an element, using the cached index of the figure's artists """
+        if element is None:
+            return ""
+        if self.reference_index is None:
+            self.reference_index = getReferenceIndex(self.figure)
+        try:
+            return self.reference_index[element]
+        except KeyError:
+            # artists that are not in the index (e.g. added without notifying the tracker) are searched directly
+            return getReference(element)
 
     def removeElement(self, element):
+        # the removal is stored with the reference the element has before it is removed
+        if self.journal is not None:
+            self.flushJournal()
+            try:
+                self.journal.write(["D" + self.get_reference(element)])
+            except OSError as err:
+                print("pylustrator: could not write the journal", self.journal.filename, err, file=sys.stderr)
         # create_key = key+".new"
         created_by_pylustrator = (element, ".new") in self.changes
         # delete changes related to this element
@@ -122,19 +407,30 @@ class ChangeTracker:
             element.set_visible(False)
         else:
             element.remove()
+        # removing an artist shifts the indices of all the following artists
+        self.reference_index = None
         self.figure.selection.remove_target(element)
 
     def addEdit(self, edit):
+        if not isinstance(edit, Edit):
+            edit = Edit(*edit)
         if self.last_edit < len(self.edits) - 1:
+            for removed in self.edits[self.last_edit + 1:]:
+                self.edits_memory -= removed.nbytes
             self.edits = self.edits[:self.last_edit + 1]
         self.edits.append(edit)
+        self.edits_memory += edit.nbytes
+        self.flushJournal()
+        # drop the oldest edits if the history uses too much memory
+        while self.edits_memory > self.edits_memory_limit and len(self.edits) > 1:
+            self.edits_memory -= self.edits.pop(0).nbytes
         self.last_edit = len(self.edits) - 1
 
     def backEdit(self):
         if self.last_edit < 0:
             return
         edit = self.edits[self.last_edit]
-        edit[0]()
+        edit.undo()
         self.last_edit -= 1
         self.figure.canvas.draw()
 
@@ -142,70 +438,166 @@ class ChangeTracker:
         if self.last_edit >= len(self.edits) - 1:
             return
         edit = self.edits[self.last_edit + 1]
-        edit[1]()
+        edit.redo()
         self.last_edit += 1
         self.figure.canvas.draw()
 
+    def get_element_restore_function(self, elements):
+        """ store the current positions of the elements and return a function that restores them """
+        elements = list(elements)
+        counts, points = getElementPositions(self.figure, elements)
+
+        def restore():
+            setElementPositions(self.figure, elements, counts, points)
+
+        restore.nbytes = points.nbytes + counts.nbytes + 8 * len(elements)
+        return restore
+
     def load(self):
-        regex = re.compile(r"(\.[^\(= ]*)(.*)")
-        command_obj_regexes = [r"fig",
-                               r"\.ax_dict\[\"[^\"]*\"\]",
-                               r"\.axes\[\d*\]",
-                               r"\.texts\[\d*\]",
-                               r"\.patches\[\d*\]",
-                               r"\.get_legend()",
-                               ]
-        command_obj_regexes = [re.compile(r) for r in command_obj_regexes]
-
-        fig = self.figure
         header = ["fig = plt.figure(%s)" % self.figure.number, "import matplotlib as mpl",
                   "fig.ax_dict = {ax.get_label(): ax for ax in fig.axes}"]
+        # the objects of the reference paths that have already been resolved
+        cache = {}
+        self.loaded_lines = set()
 
-        block = getTextFromFile(header[0], stack_position)
+        block = getTextFromFile(header[0], self.stack_position)
         for line in block:
             line = line.strip()
             if line == "" or line in header or line.startswith("#"):
                 continue
+            self.loaded_lines.add(line)
 
-            # try to identify the command object of the line
-            command_obj = ""
-            for r in command_obj_regexes:
-                try:
-                    found = r.match(line).group()
-                    line = line[len(found):]
-                    command_obj += found
-                except AttributeError:
-                    pass
-
-            try:
-                command, parameter = regex.match(line).groups()
-            except AttributeError:  # no regex match
+            change = self.parseLine(line, cache)
+            if change is None:
                 continue
+            reference_obj, reference_command, command_obj, command = change
+            self.changes[reference_obj, reference_command] = (command_obj, command)
+        self.sorted_changes()
 
-            m = re.match(r".*# id=(.*)", line)
-            if m:
-                key = m.groups()[0]
-            else:
-                key = command_obj + command
+    def parseLine(self, line, cache):
+        """ get the reference object and command and the command object and command of a line of generated code """
+        # identify the command object of the line
+        parts, end = splitReference(line)
+        if parts is None:
+            return None
+        command_obj = line[:end]
 
-            # by default reference and command object are the same
-            reference_obj = command_obj
-            reference_command = command
+        # split the command (e.g. ".set_position") from its parameters
+        command, parameter = splitCommand(line[end:])
+        if command is None:
+            return None
 
-            if command == ".set_xticks" or command == ".set_yticks" or command == ".set_xlabels" or command == ".set_ylabels":
-                if line.find("minor=True"):
-                    reference_command = command + "_minor"
+        index = line.find("# id=")
+        if index != -1:
+            key = line[index + len("# id="):]
+        else:
+            key = command_obj + command
 
-            # for new created texts, the reference object is the text and not the axis/figure
-            if command == ".text" or command == ".annotate" or command == ".add_patch":
-                reference_obj, _ = re.match(r"(.*)(\..*)", key).groups()
-                reference_command = ".new"
+        # by default reference and command object are the same
+        reference_obj = command_obj
+        reference_parts = parts
+        reference_command = command
 
-            command_obj = eval(command_obj)
-            reference_obj = eval(reference_obj)
+        if command == ".set_xticks" or command == ".set_yticks" or command == ".set_xlabels" or command == ".set_ylabels":
+            if "minor=True" in parameter:
+                reference_command = command + "_minor"
 
-            self.changes[reference_obj, reference_command] = (command_obj, command + parameter)
-        self.sorted_changes()
+        # for new created texts, the reference object is the text and not the axis/figure
+        if command == ".text" or command == ".annotate" or command == ".add_patch":
+            reference_obj = key.rsplit(".", 1)[0]
+            reference_parts, end = splitReference(reference_obj)
+            if reference_parts is None or end != len(reference_obj):
+                print("pylustrator: could not parse the id of line", line)
+                return None
+            reference_command = ".new"
+
+        try:
+            command_obj = resolveReference(self.figure, command_obj, parts, cache)
+            reference_obj = resolveReference(self.figure, reference_obj, reference_parts, cache)
+        except (IndexError, KeyError, AttributeError) as err:
+            print("pylustrator: could not find the object of line", line, err)
+            return None
+        return reference_obj, reference_command, command_obj, command + parameter
+
+    def openJournal(self):
+        """ open the journal of the figure and apply the changes that were not saved before pylustrator was closed """
+        self.journal = None
+        self.journal_dirty = {}
+        self.journal_time = time.monotonic()
+        if not os.path.isfile(self.stack_position.filename):
+            return
+        self.journal = Journal(Journal.getFilename(self.stack_position.filename, self.figure.number))
+        records = self.journal.read()
+        if len(records) == 0:
+            return
+        print("pylustrator: restoring %d unsaved changes from" % len(records), self.journal.filename)
+        if getattr(self.figure, "ax_dict", None) is None:
+            self.figure.ax_dict = {ax.get_label(): ax for ax in self.figure.axes}
+        for record in records:
+            kind, line = record[:1], record[1:]
+            # adding or removing artists changes the references, therefore nothing is cached between records
+            if kind == "D":
+                parts, end = splitReference(line)
+                try:
+                    element = resolveReference(self.figure, line, parts, {})
+                except (TypeError, IndexError, KeyError, AttributeError) as err:
+                    print("pylustrator: could not find the removed object", line, err)
+                    continue
+                created_by_pylustrator = (element, ".new") in self.changes
+                for key in [k for k in self.changes if k[0] == element]:
+                    del self.changes[key]
+                if created_by_pylustrator:
+                    element.remove()
+                self.reference_index = None
+                continue
+            # elements created by the saved code already exist
+            if "# id=" in line and line in self.loaded_lines:
+                continue
+            parts, end = splitReference(line)
+            try:
+                if parts is None:
+                    raise ValueError("no object")
+                applyCommand(self.figure, resolveReference(self.figure, line[:end], parts, {}), line[end:])
+            except Exception as err:
+                print("pylustrator: could not restore the line", line, err)
+                continue
+            change = self.parseLine(line, {})
+            if change is None:
+                continue
+            reference_obj, reference_command, command_obj, command = change
+            self.changes[reference_obj, reference_command] = (command_obj, command)
+            if reference_command == ".new":
+                self.reference_index = None
+        self.saved = False
+
+    def discardJournal(self):
+        """ remove the unsaved changes from the journal, e.g. when the user closes the figure without saving """
+        if self.journal is None:
+            return
+        self.journal_dirty = {}
+        try:
+            self.journal.clear()
+        except OSError as err:
+            print("pylustrator: could not clear the journal", self.journal.filename, err, file=sys.stderr)
+
+    def flushJournal(self):
+        """ write the changes since the last flush to the journal """
+        if self.journal_timer is not None:
+            self.journal_timer.stop()
+            self.journal_timer = None
+        if self.journal is None or len(self.journal_dirty) == 0:
+            return
+        records = []
+        for key in self.journal_dirty:
+            if key in self.changes:
+                command_obj, command = self.changes[key]
+                records.append("C" + self.get_reference(command_obj) + str(command))
+        self.journal_dirty = {}
+        self.journal_time = time.monotonic()
+        try:
+            self.journal.write(records)
+        except OSError as err:
+            print("pylustrator: could not write the journal", self.journal.filename, err, file=sys.stderr)
 
     def sorted_changes(self):
         indices = []
@@ -214,13 +606,13 @@ class ChangeTracker:
             if isinstance(reference_obj, Figure):
                 obj_indices = ("", "", "")
             if isinstance(reference_obj, matplotlib.axes._axes.Axes):
-                obj_indices = (getReference(reference_obj), "", "")
+                obj_indices = (self.get_reference(reference_obj), "", "")
             if isinstance(reference_obj, matplotlib.text.Text) or isinstance(reference_obj, matplotlib.patches.Patch):
                 if reference_command == ".new":
                     index = "0"
                 else:
                     index = "1"
-                obj_indices = (getReference(reference_obj.axes), getReference(reference_obj), index)
+                obj_indices = (self.get_reference(reference_obj.axes), self.get_reference(reference_obj), index)
             indices.append(
                 [(reference_obj, reference_command), self.changes[reference_obj, reference_command], obj_indices])
 
@@ -229,12 +621,29 @@ class ChangeTracker:
         for s in srt:
             command_obj, command = s[1]
             try:
-                output.append(getReference(command_obj) + command)
+                output.append(self.get_reference(command_obj) + str(command))
             except TypeError as err:
                 print(err)
         return output
 
-    def save(self):
+    def close(self):
+        """ stop tracking the figure, e.g. because its window was closed """
+        unregisterTracker(self)
+
+    def save(self, callback=None):
+        """ save the changes to the script file
+
+        The unsaved changes of the other figures of the same script are saved, too, as they are written in the same
+        pass over the file. The callback is called from the saving thread with None when the file has been written or
+        with the exception if the writing failed.
+        """
+        for tracker in getTrackers(self.stack_position.filename):
+            if tracker is not self and not tracker.saved:
+                tracker.queueSave()
+        self.queueSave(callback)
+
+    def queueSave(self, callback=None):
+        """ generate the block of the figure and queue it to be written to the script file by a background thread """
         header = ["fig = plt.figure(%s)" % self.figure.number, "import matplotlib as mpl",
                   "fig.ax_dict = {ax.get_label(): ax for ax in fig.axes}"]
 
@@ -250,38 +659,336 @@ class ChangeTracker:
                 output.append(header[1])
         output.append("#% end: automatic generated code from pylustrator")
         # print("\n".join(output))
-        insertTextToFile(output, stack_position, header[0])
         self.saved = True
+        # the journal batches up to here are contained in the saved block
+        self.flushJournal()
+        journal_batches = self.journal.batches if self.journal is not None else 0
 
+        def finished(error):
+            if error is not None:
+                self.saved = False
+                print("pylustrator: saving to", self.stack_position.filename, "failed:", error, file=sys.stderr)
+            elif self.journal is not None:
+                try:
+                    self.journal.discard(journal_batches)
+                except OSError as err:
+                    print("pylustrator: could not clear the journal", self.journal.filename, err, file=sys.stderr)
+            if callback is not None:
+                callback(error)
+
+        # the file is written in the background, so that the gui does not freeze on slow disks
+        save_queue.put(self.stack_position, header[0], output, finished)
+
+
+# the functions that restored commands can call, besides the setters and getters of the artists
+command_functions = {
+    "dict": dict,
+    "mpl.patches.Rectangle": matplotlib.patches.Rectangle,
+    "mpl.patches.Ellipse": matplotlib.patches.Ellipse,
+    "mpl.patches.FancyArrowPatch": matplotlib.patches.FancyArrowPatch,
+    "plt.imread": matplotlib.pyplot.imread,
+    "np.float64": np.float64,
+    "np.int64": np.int64,
+}
+# the arithmetic operators that commands can use, e.g. for the figure size in inches
+command_operators = {
+    ast.Add: lambda a, b: a + b,
+    ast.Sub: lambda a, b: a - b,
+    ast.Mult: lambda a, b: a * b,
+    ast.Div: lambda a, b: a / b,
+}
+# the methods that create new artists
+command_methods = {"text", "annotate", "add_patch", "add_axes", "imshow", "_set_loc"}
+# the attributes that commands can assign to
+command_attributes = {"labelpad", "center", "width", "height", "xy"}
+
+
+def applyCommand(figure, obj, command):
+    """ apply a command of the generated code (e.g. '.set_position([0.1, 0.2, 0.3, 0.4])') to the object
+
+    The command is not executed as code: it is parsed and only literals, references to the figure, the setters and
+    getters of the artists and the functions in command_functions are evaluated.
+    """
+    tree = ast.parse("_" + command.strip(), mode="exec")
+    if len(tree.body) != 1:
+        raise ValueError("only one command is allowed")
+    statement = tree.body[0]
+
+    def dotted_name(node):
+        if isinstance(node, ast.Name):
+            return node.id
+        if isinstance(node, ast.Attribute):
+            parent = dotted_name(node.value)
+            if parent is not None:
+                return parent + "." + node.attr
+        return None
+
+    def evaluate(node):
+        try:
+            return ast.literal_eval(node)
+        except ValueError:
+            pass
+        if isinstance(node, ast.Name):
+            if node.id == "_":
+                return obj
+            if node.id == "fig":
+                return figure
+        elif isinstance(node, ast.BinOp) and type(node.op) in command_operators:
+            left, right = evaluate(node.left), evaluate(node.right)
+            if not isinstance(left, numbers.Number) or not isinstance(right, numbers.Number):
+                raise ValueError("arithmetic is only allowed with numbers")
+            return command_operators[type(node.op)](left, right)
+        elif isinstance(node, (ast.List, ast.Tuple)):
+            values = [evaluate(element) for element in node.elts]
+            return values if isinstance(node, ast.List) else tuple(values)
+        elif isinstance(node, ast.Attribute) and not node.attr.startswith("_"):
+            return getattr(evaluate(node.value), node.attr)
+        elif isinstance(node, ast.Subscript):
+            index = node.slice.value if isinstance(node.slice, ast.Index) else node.slice
+            return evaluate(node.value)[ast.literal_eval(index)]
+        elif isinstance(node, ast.Call):
+            name = dotted_name(node.func)
+            if name in command_functions:
+                function = command_functions[name]
+            elif isinstance(node.func, ast.Attribute) and (node.func.attr.startswith("set_") or
+                                                           node.func.attr.startswith("get_") or
+                                                           node.func.attr in command_methods):
+                function = getattr(evaluate(node.func.value), node.func.attr)
+            else:
+                raise ValueError("function %s is not allowed" % ast.dump(node.func))
+            args = [evaluate(arg) for arg in node.args]
+            kwargs = {keyword.arg: evaluate(keyword.value) for keyword in node.keywords if keyword.arg is not None}
+            return function(*args, **kwargs)
+        raise ValueError("expression %s is not allowed" % ast.dump(node))
+
+    if isinstance(statement, ast.Expr):
+        evaluate(statement.value)
+    elif isinstance(statement, ast.Assign) and len(statement.targets) == 1 and \
+            isinstance(statement.targets[0], ast.Attribute) and statement.targets[0].attr in command_attributes:
+        setattr(evaluate(statement.targets[0].value), statement.targets[0].attr, evaluate(statement.value))
+    else:
+        raise ValueError("statement %s is not allowed" % ast.dump(statement))
+
+
+class Journal:
+    """ an append-only file next to the script that stores the changes which have not been saved yet
+
+    Each record is stored as its length and crc32 followed by the payload, records are grouped in batches that end
+    with an "E" record. When pylustrator crashes while writing, the incomplete batch is ignored when the journal is read.
+    """
+    header = struct.Struct("<II")
+    # fsync the journal at most every sync_interval seconds
+    sync_interval = 1
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.fp = None
+        self.size = 0
+        self.last_sync = 0
+        # the batches are numbered in the order they are written, batch_ends are the offsets of the ends of the batches
+        # that are still in the file, starting with the batch first_batch
+        self.batches = 0
+        self.first_batch = 0
+        self.batch_ends = []
+
+    @staticmethod
+    def getFilename(script_filename, figure_number):
+        directory, basename = os.path.split(os.path.abspath(script_filename))
+        return os.path.join(directory, ".%s.fig%s.pylustrator-journal" % (basename, figure_number))
+
+    def pack(self, payload):
+        payload = payload.encode("utf-8")
+        return self.header.pack(len(payload), zlib.crc32(payload)) + payload
+
+    def read(self):
+        """ get the payloads of all complete batches and remove incomplete records from the end of the file """
+        try:
+            with open(self.filename, "rb") as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            return []
+        records = []
+        batch = []
+        offset = 0
+        while offset + self.header.size <= len(data):
+            length, crc = self.header.unpack_from(data, offset)
+            start = offset + self.header.size
+            payload = data[start:start + length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            offset = start + length
+            payload = payload.decode("utf-8")
+            if payload == "E":
+                records.extend(batch)
+                batch = []
+                self.size = offset
+                self.batch_ends.append(offset)
+                self.batches += 1
+            else:
+                batch.append(payload)
+        if self.size != len(data):
+            with open(self.filename, "r+b") as fp:
+                fp.truncate(self.size)
+        return records
+
+    def write(self, payloads):
+        """ append the payloads to the journal as one batch """
+        data = b"".join([self.pack(payload) for payload in payloads] + [self.pack("E")])
+        with self.lock:
+            if self.fp is None:
+                self.fp = open(self.filename, "ab")
+            self.fp.write(data)
+            self.fp.flush()
+            self.size += len(data)
+            self.batch_ends.append(self.size)
+            self.batches += 1
+            if time.monotonic() - self.last_sync > self.sync_interval:
+                os.fsync(self.fp.fileno())
+                self.last_sync = time.monotonic()
+
+    def discard(self, batches):
+        """ remove the first batches (by their number) from the journal, e.g. because they have been saved
+
+        Batches that have already been removed are skipped, therefore it does not matter if an earlier save finishes
+        later.
+        """
+        with self.lock:
+            count = batches - self.first_batch
+            if count <= 0:
+                return
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+            if count >= len(self.batch_ends):
+                self.remove()
+                return
+            offset = self.batch_ends[count - 1]
+            with open(self.filename, "rb") as fp:
+                fp.seek(offset)
+                data = fp.read()
+            directory, basename = os.path.split(self.filename)
+            fd, tmp_filename = tempfile.mkstemp(prefix=basename, suffix=".tmp", dir=directory)
+            try:
+                with open(fd, "wb") as fp:
+                    fp.write(data)
+                    fp.flush()
+                    os.fsync(fp.fileno())
+                os.replace(tmp_filename, self.filename)
+            except BaseException:
+                os.remove(tmp_filename)
+                raise
+            self.size = len(data)
+            self.batch_ends = [end - offset for end in self.batch_ends[count:]]
+            self.first_batch = batches
+
+    def clear(self):
+        """ remove all batches from the journal, e.g. because the user discarded the changes """
+        with self.lock:
+            if self.fp is not None:
+                self.fp.close()
+                self.fp = None
+            self.remove()
+
+    def remove(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+        self.size = 0
+        self.batch_ends = []
+        self.first_batch = self.batches
+
+
+class SaveQueue:
+    """ a background thread that writes the saved blocks to the script files
+
+    Saves that follow each other within `delay` seconds are combined, the blocks of all figures of one file are written
+    in a single pass over the file.
+    """
+    delay = 0.2
+
+    def __init__(self):
+        self.jobs = {}
+        self.condition = threading.Condition()
+        self.last_put = 0
+        self.busy = False
+        self.flushing = False
+        self.thread = None
+
+    def put(self, stack_pos, figure_id_line, new_block, callback=None):
+        """ queue a block to be written to the file of the entry point, a pending version of the block is replaced """
+        with self.condition:
+            blocks, callbacks = self.jobs.setdefault(os.path.abspath(stack_pos.filename), ({}, []))
+            blocks[figure_id_line] = (new_block, stack_pos)
+            if callback is not None and callback not in callbacks:
+                callbacks.append(callback)
+            self.last_put = time.monotonic()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="pylustrator save", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                # wait until no new save was requested for some time
+                while not self.flushing:
+                    remaining = self.last_put + self.delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                jobs = self.jobs
+                self.jobs = {}
+                self.busy = True
+            for filename, (blocks, callbacks) in jobs.items():
+                try:
+                    insertBlocksToFile(filename, [(figure_id_line, new_block, stack_pos)
+                                                  for figure_id_line, (new_block, stack_pos) in blocks.items()])
+                    error = None
+                except Exception as err:
+                    error = err
+                    # without a callback, nobody would report the error
+                    if len(callbacks) == 0:
+                        print("pylustrator: saving to", filename, "failed:", file=sys.stderr)
+                        traceback.print_exc()
+                for callback in callbacks:
+                    try:
+                        callback(error)
+                    except Exception:
+                        traceback.print_exc()
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
+
+    def flush(self):
+        """ block until all queued saves are written """
+        with self.condition:
+            self.flushing = True
+            self.condition.notify_all()
+            while self.jobs or self.busy:
+                self.condition.wait()
+            self.flushing = False
 
-def getTextFromFile(block_id, stack_pos):
-    block = None
 
+save_queue = SaveQueue()
+# do not lose saves that are still queued when the interpreter exits
+atexit.register(save_queue.flush)
+
+
+def getTextFromFile(block_id, stack_pos):
     if not stack_pos.filename.endswith('.py'):
         raise RuntimeError("pylustrator must used in a python file (*.py); not a shell session or notebook.")
 
-    with open(stack_pos.filename, 'r', encoding="utf-8") as fp1:
-        for lineno, line in enumerate(fp1, start=1):
-            # if we are currently reading a pylustrator block
-            if block is not None:
-                # add the line to the block
-                block.add(line)
-                # and see if we have found the end
-                if line.strip().startswith("#% end:"):
-                    block.end()
-            # if there is a new pylustrator block
-            elif line.strip().startswith("#% start:"):
-                block = Block(line)
-
-            # if we are currently reading a block, continue with the next line
-            if block is not None and not block.finished:
-                continue
-
-            if block is not None and block.finished:
-                if block.id == block_id:
-                    return block
-            block = None
-    return []
+    with open(stack_pos.filename, 'rb') as fp:
+        index = getBlockIndex(fp)
+        if block_id not in index.ids:
+            return []
+        start, end, indent = index.blocks[index.ids[block_id]][1:]
+        # only the block itself has to be read from the file
+        fp.seek(start)
+        text = fp.read(end - start).decode("utf-8")
+    return Block.fromText(text)
 
 
 class Block:
@@ -289,19 +996,34 @@ class Block:
     finished = False
 
     def __init__(self, line):
-        self.text = line
-        self.size = 1
+        self.lines = [line]
         self.indent = getIndent(line)
 
+    @staticmethod
+    def fromText(text):
+        lines = text.splitlines(True)
+        block = Block(lines[0])
+        for line in lines[1:]:
+            block.add(line)
+        block.end()
+        return block
+
     def add(self, line):
         if self.id is None:
             self.id = line.strip()
-        self.text += line
-        self.size += 1
+        self.lines.append(line)
 
     def end(self):
         self.finished = True
 
+    @property
+    def size(self):
+        return len(self.lines)
+
+    @property
+    def text(self):
+        return "".join(self.lines)
+
     def __iter__(self):
         return iter(self.text.split("\n"))
 
@@ -315,87 +1037,202 @@ def getIndent(line):
     return indent
 
 
-def addLineCounter(fp):
-    fp.lineno = 0
-    write = fp.write
+class BlockIndex:
+    """ the positions of the pylustrator blocks in the content of a file
+
+    blocks is a list of (id, start, end, indent) with the byte offsets of the blocks including their start and end
+    line, ids maps the id line of a block to its first occurrence in blocks. newline is the line break of the file.
+    """
+    block_pattern = re.compile(rb"^[ \t]*#% (start|end):", re.MULTILINE)
+
+    def __init__(self, data):
+        self.size = len(data)
+        # the offsets of all line breaks, to convert between offsets and line numbers
+        self.newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+        # new lines are written with the line break style of the file
+        self.newline = "\r\n" if len(self.newlines) and data[self.newlines[0] - 1:self.newlines[0]] == b"\r" else "\n"
+        self.blocks = []
+        self.ids = {}
+        start = None
+        for match in self.block_pattern.finditer(data):
+            if match.group(1) == b"start":
+                if start is None:
+                    start = match.start()
+                continue
+            if start is None:
+                continue
+            end = self.getOffset(self.getLineNumber(match.start()) + 1)
+            start_line = self.getLineNumber(start)
+            # the id of a block is its first line after the start line
+            block_id = data[self.getOffset(start_line + 1):self.getOffset(start_line + 2)].decode("utf-8").strip()
+            start_text = data[start:self.getOffset(start_line + 1)].decode("utf-8")
+            self.ids.setdefault(block_id, len(self.blocks))
+            self.blocks.append((block_id, start, end, getIndent(start_text)))
+            start = None
+
+    def getLineNumber(self, offset):
+        """ the line number of the line that contains the offset """
+        return int(np.searchsorted(self.newlines, offset)) + 1
+
+    def getOffset(self, lineno):
+        """ the offset of the start of the line with the given number """
+        if lineno <= 1:
+            return 0
+        if lineno - 2 >= len(self.newlines):
+            return self.size
+        return int(self.newlines[lineno - 2]) + 1
+
+
+# the block indices of the script files by filename, together with the modification time and size they belong to
+block_indices = {}
+
+
+def getBlockIndex(fp, data=None):
+    """ get the BlockIndex of a file opened in binary mode, it is only rebuilt if the file changed
+
+    data can be the already read content of the file.
+    """
+    filename = os.path.abspath(fp.name)
+    stat = os.fstat(fp.fileno())
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = block_indices.get(filename)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    if data is None:
+        fp.seek(0)
+        data = fp.read()
+    index = BlockIndex(data)
+    block_indices[filename] = (key, index)
+    return index
 
-    def write_with_linenumbers(line):
-        write(line)
-        fp.lineno += line.count("\n")
 
-    fp.write = write_with_linenumbers
+def writeFileAtomic(filename, data):
+    """ write the data to a temporary file next to the target and move it over the target in one atomic step """
+    directory, basename = os.path.split(os.path.abspath(filename))
+    fd, tmp_filename = tempfile.mkstemp(prefix="." + basename, suffix=".tmp", dir=directory)
+    try:
+        with open(fd, 'wb') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        # keep the permissions of the original file
+        shutil.copymode(filename, tmp_filename)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+# the change trackers of the open figures by file, the line numbers of their entry points are updated when blocks are
+# written to the file
+trackers = {}
+
+
+def registerTracker(tracker):
+    trackers.setdefault(os.path.abspath(tracker.stack_position.filename), []).append(tracker)
+
+
+def unregisterTracker(tracker):
+    filename = os.path.abspath(tracker.stack_position.filename)
+    file_trackers = [t for t in trackers.get(filename, []) if t is not tracker]
+    if len(file_trackers):
+        trackers[filename] = file_trackers
+    else:
+        trackers.pop(filename, None)
+
+
+def getTrackers(filename):
+    return list(trackers.get(os.path.abspath(filename), []))
 
 
 def insertTextToFile(new_block, stack_pos, figure_id_line):
-    block = None
-    written = False
-    written_end = False
-    lineno_stack = None
-    # open a temporary file with the same name for writing
-    with open(stack_pos.filename + ".tmp", 'w', encoding="utf-8") as fp2:
-        addLineCounter(fp2)
-        # open the current python file for reading
-        with open(stack_pos.filename, 'r', encoding="utf-8") as fp1:
-            # iterate over all lines and line numbers
-            for fp1.lineno, line in enumerate(fp1, start=1):
-                # if we are currently reading a pylustrator block
-                if block is not None:
-                    # add the line to the block
-                    block.add(line)
-                    # and see if we have found the end
-                    if line.strip().startswith("#% end:"):
-                        block.end()
-                        line = ""
-                # if there is a new pylustrator block
-                elif line.strip().startswith("#% start:"):
-                    block = Block(line)
-
-                # if we are currently reading a block, continue with the next line
-                if block is not None and not block.finished:
-                    continue
+    insertBlocksToFile(stack_pos.filename, [(figure_id_line, new_block, stack_pos)])
+
+
+def insertBlocksToFile(filename, blocks):
+    """ write the blocks of several figures to a file in one pass
+
+    blocks is a list of (figure_id_line, new_block, stack_pos). A block replaces the blocks with the same id line or, if
+    the file has none, is inserted before its entry point. Afterwards the line numbers of all entry points in the file
+    are moved to the new positions of their lines.
+    """
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+        index = getBlockIndex(fp, data)
+
+    new_blocks = {}
+    for figure_id_line, new_block, stack_pos in blocks:
+        new_blocks[figure_id_line] = new_block
+
+    # the parts of the file to replace, as (start, end, figure_id_line, indent)
+    replacements = []
+    for block_id, start, end, indent in index.blocks:
+        if block_id in new_blocks:
+            replacements.append((start, end, block_id, indent))
+    # blocks that are not in the file yet are inserted at their entry point (e.g. plt.show())
+    found = set(replacement[2] for replacement in replacements)
+    for figure_id_line, new_block, stack_pos in blocks:
+        if figure_id_line in found or stack_pos.lineno is None or stack_pos.lineno > len(index.newlines) + 1:
+            continue
+        offset = index.getOffset(stack_pos.lineno)
+        line = data[offset:index.getOffset(stack_pos.lineno + 1)].decode("utf-8")
+        replacements.append((offset, offset, figure_id_line, getIndent(line)))
+        found.add(figure_id_line)
+    replacements.sort(key=lambda replacement: replacement[0])
+
+    output = []
+    written = {}
+    # the changes of the line numbers, as (offset, number of added lines) at the end of each replaced part
+    line_shifts = []
+    shift = 0
+    position = 0
+    for start, end, figure_id_line, indent in replacements:
+        output.append(data[position:start])
+        new_text = "".join(indent + line_text + index.newline for line_text in new_blocks[figure_id_line])
+        output.append(new_text.encode("utf-8"))
+        start_line = index.getLineNumber(start) + shift
+        written[figure_id_line] = (start_line, start_line + len(new_blocks[figure_id_line]) - 1)
+        shift += len(new_blocks[figure_id_line]) - (index.getLineNumber(end) - index.getLineNumber(start))
+        line_shifts.append((start, end, shift))
+        position = end
+    output.append(data[position:])
+
+    # the new positions of the entry points, as we have inserted stuff in the new file which can change their positions
+    stack_positions = {id(stack_pos): stack_pos for figure_id_line, new_block, stack_pos in blocks}
+    for tracker in getTrackers(filename):
+        stack_positions[id(tracker.stack_position)] = tracker.stack_position
+    new_linenos = []
+    for stack_pos in stack_positions.values():
+        if stack_pos.lineno is None:
+            continue
+        offset = index.getOffset(stack_pos.lineno)
+        lineno_shift = 0
+        for start, end, shift in line_shifts:
+            # lines inside of a replaced block keep their number
+            if start < offset < end:
+                break
+            if end <= offset:
+                lineno_shift = shift
+        else:
+            new_linenos.append((stack_pos, stack_pos.lineno + lineno_shift))
+
+    new_data = b"".join(output)
+    # if the blocks did not change, there is no need to touch the file
+    if new_data == data:
+        for figure_id_line in new_blocks:
+            print("save", figure_id_line, "to", filename, "unchanged")
+        return
+    # replace the old file with the new content
+    writeFileAtomic(filename, new_data)
+    block_indices.pop(os.path.abspath(filename), None)
+    # only move the entry points when the file has been written
+    for stack_pos, lineno in new_linenos:
+        stack_pos.lineno = lineno
+    for figure_id_line in new_blocks:
+        if figure_id_line in written:
+            print("save", figure_id_line, "to", filename, "line %d-%d" % written[figure_id_line])
+
 
-                # the current block is finished
-                if block is not None:
-                    # either it is the block we want to save, then replace the old block with the new
-                    if block.id == figure_id_line:
-                        # remember that we wrote the new block
-                        written = fp2.lineno + 1
-                        # write the new block to the target file instead of the current block
-                        indent = block.indent
-                        for line_text in new_block:
-                            fp2.write(indent + line_text + "\n")
-                        written_end = fp2.lineno
-                    # or it is another block, then we just write it
-                    else:
-                        # the we just copy the current block into the new file
-                        fp2.write(block.text)
-                    # we already handled this block
-                    block = None
-
-                # if we are at the entry point (e.g. plt.show())
-                if fp1.lineno == stack_pos.lineno:
-                    # and if we not have written the new block
-                    if not written:
-                        written = fp2.lineno + 1
-                        # we write it now to the target file
-                        indent = getIndent(line)
-                        for line_text in new_block:
-                            fp2.write(indent + line_text + "\n")
-                        written_end = fp2.lineno
-                    # and we store the position where we will write the entry point (e.g. the plt.show())
-                    lineno_stack = fp2.lineno + 1
-                # transfer the current line to the new file
-                fp2.write(line)
-
-    # update the position of the entry point, as we have inserted stuff in the new file which can change the position
-    stack_pos.lineno = lineno_stack
-
-    # now copy the temporary file over the old file
-    with open(stack_pos.filename + ".tmp", 'r', encoding="utf-8") as fp2:
-        with open(stack_pos.filename, 'w', encoding="utf-8") as fp1:
-            for line in fp2:
-                fp1.write(line)
-    print("save", figure_id_line, "to", stack_pos.filename, "line %d-%d" % (written, written_end))
 class UndoRedo:
     def __init__(self, elements, name):
         self.elements = list(elements)
@@ -413,5 +1250,7 @@ class UndoRedo:
             self.redo = self.change_tracker.get_element_restore_function(self.elements)
             self.redo()
             self.figure.canvas.draw()
-            self.figure.signals.figure_selection_property_changed.emit()
-            self.change_tracker.addEdit([self.undo, self.redo, self.name])
\ No newline at end of file
+            signals = getattr(self.figure, "signals", None)
+            if signals is not None:
+                signals.figure_selection_property_changed.emit()
+            self.change_tracker.addEdit(Edit(self.undo, self.redo, self.name))
\ No newline at end of file
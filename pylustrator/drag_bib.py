@@ -21,7 +21,6 @@
 
 from __future__ import division, print_function
 import numpy as np
-import traceback
 import matplotlib.pyplot as plt
 from matplotlib.text import Text
 from matplotlib.lines import Line2D
@@ -32,6 +31,7 @@ import matplotlib
 import uuid
 import re
 from natsort import natsorted
+from .helper_functions import getEntryPoint
 
 DIR_X0 = 1
 DIR_Y0 = 2
@@ -104,7 +104,7 @@ class FigureDragger:
             self.make_dragable(text)
 
         # store the position where StartPylustrator was called
-        self.stack_position = traceback.extract_stack()[-3]
+        self.stack_position = getEntryPoint()
 
         self.fig_inch_size = fig.get_size_inches()
 
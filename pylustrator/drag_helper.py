@@ -20,19 +20,79 @@
 # along with Pylustrator. If not, see <http://www.gnu.org/licenses/>
 
 from __future__ import division, print_function
+import time
+import weakref
+from numbers import Number
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.text import Text
 from matplotlib.patches import Rectangle, Ellipse
 from matplotlib.axes import Axes
-from .snap import TargetWrapper, getSnaps, checkSnaps, checkSnapsActive
-from .change_tracker import ChangeTracker, UndoRedo
+from matplotlib.lines import Line2D
+from matplotlib.collections import Collection, PathCollection, LineCollection
+from matplotlib.backend_bases import TimerBase
+from matplotlib.transforms import Bbox, IdentityTransform
+from .snap import TargetWrapper, getSnaps, checkSnaps, checkSnapsActive, SnapOverlay, Guides, checkXLabel, checkYLabel
+from .change_tracker import ChangeTracker, UndoRedo, PositionEdit, getElementPositions
 
 DIR_X0 = 1
 DIR_Y0 = 2
 DIR_X1 = 4
 DIR_Y1 = 8
 
+# the maximal number of times per second that mouse motion is processed, None to process every event
+max_fps = 60
+
+
+class MotionCoalescer:
+    """ process only the latest of the motion events that arrive while the previous one is rendered
+
+    The pending event is processed by a timer at most max_fps times per second, events that arrive in between replace
+    it instead of queuing up. Canvases without a timer process every event directly.
+    """
+
+    def __init__(self, canvas, callback, fps=None):
+        self.canvas = canvas
+        self.callback = callback
+        self.fps = fps
+        self.pending = None
+        self.timer = None
+        self.next_time = 0
+
+    def put(self, event):
+        self.pending = event
+        fps = self.fps or max_fps
+        if not fps:
+            return self.flush()
+        if self.timer is None:
+            delay = max(self.next_time - time.perf_counter(), 0)
+            timer = self.canvas.new_timer(interval=int(delay * 1000))
+            if type(timer) is TimerBase:
+                return self.flush()
+            timer.single_shot = True
+            timer.add_callback(self.flush)
+            self.timer = timer
+            timer.start()
+
+    def flush(self):
+        """ process the pending event now, e.g. to process the last position when the mouse button is released """
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+        event = self.pending
+        self.pending = None
+        if event is not None:
+            fps = self.fps or max_fps
+            self.next_time = time.perf_counter() + (1 / fps if fps else 0)
+            self.callback(event)
+
+    def clear(self):
+        """ drop the pending event """
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer = None
+        self.pending = None
+
 
 class GrabFunctions(object):
     figure = None
@@ -48,10 +108,11 @@ class GrabFunctions(object):
         self.dir = dir
         self.snaps = []
         self.no_height = no_height
+        self.motion = MotionCoalescer(self.figure.canvas, self.movedEvent)
 
     def on_motion(self, evt):
         if self.got_artist:
-            self.movedEvent(evt)
+            self.motion.put(evt)
             self.moved = True
 
     def button_press_event(self, evt):
@@ -65,6 +126,10 @@ class GrabFunctions(object):
         if self.got_artist:
             self.got_artist = False
             self.figure.canvas.mpl_disconnect(self._c1)
+            # move the targets exactly to the position where the mouse was released
+            if self.moved:
+                self.motion.put(event)
+                self.motion.flush()
             self.releasedEvent(event)
 
     def clickedEvent(self, event):
@@ -75,12 +140,15 @@ class GrabFunctions(object):
             s.remove()
         self.snaps = []
 
-        self.snaps = getSnaps(self.targets, self.dir, no_height=self.no_height)
+        self.snaps = getSnaps(self.targets, self.dir, no_height=self.no_height,
+                              guides=getattr(self.figure, "guides", None))
 
     def releasedEvent(self, event):
         for snap in self.snaps:
             snap.remove()
         self.snaps = []
+        self.parent.snap_overlay.clear()
+        self.parent.end_blit()
 
         self.parent.end_move()
 
@@ -99,6 +167,20 @@ class GrabFunctions(object):
 
 class GrabbableRectangleSelection(GrabFunctions):
     grabbers = None
+    # the figure without the moved elements during a drag, to only redraw the moved elements
+    background = None
+    animated_artists = None
+    animated_states = None
+
+    # the arrow keys move the targets by nudge_step pixels (with shift by nudge_step_shift)
+    nudge_keys = {"left": (-1, 0), "right": (1, 0), "down": (0, -1), "up": (0, 1),
+                  "shift+left": (-1, 0), "shift+right": (1, 0), "shift+down": (0, -1), "shift+up": (0, 1)}
+    nudge_step = 1
+    nudge_step_shift = 10
+    # the time in seconds without key presses after which the nudges are added as one undo step
+    nudge_timeout = 0.5
+    nudge_offset = None
+    nudge_timer = None
 
     def addGrabber(self, x, y, dir, GrabberClass):
         # add a grabber object at the given coordinates
@@ -126,46 +208,69 @@ class GrabbableRectangleSelection(GrabFunctions):
         self.c4 = self.figure.canvas.mpl_connect('key_press_event', self.keyPressEvent)
 
         self.targets = []
-        self.targets_rects = []
+        # the extents (x0, y0, x1, y1) in pixels of the outline and of all points of each target, preallocated
+        self.targets_extents = np.zeros((16, 4))
+        self.targets_bounds = np.zeros((16, 4))
+        # the outlines of all targets are drawn by one collection, each twice: white and black dashed
+        self.outlines = LineCollection([], transform=IdentityTransform(), clip_on=False, linewidths=1, zorder=900,
+                                       colors=["w", "k"], linestyles=["-", "--"], label="_tmp_snap")
+        self.figure.add_artist(self.outlines)
+        self.snap_overlay = SnapOverlay(figure)
 
         self.hide_grabber()
 
-    def add_target(self, target):
+    def add_target(self, target, update=True):
+        # a pending nudge belongs to the previous selection
+        self.finish_nudge()
         target = TargetWrapper(target)
         self.targets.append(target)
 
-        new_points = np.array(target.get_positions())
-
-        x0, y0, x1, y1 = np.min(new_points[:, 0]), np.min(new_points[:, 1]), np.max(new_points[:, 0]), np.max(
-            new_points[:, 1])
-        rect1 = Rectangle((x0, y0), x1 - x0, y1 - y0, picker=False, figure=self.figure, linestyle="-", edgecolor="w",
-                          facecolor="#FFFFFF00", zorder=900, label="_rect for %s" % str(target))
-        rect2 = Rectangle((x0, y0), x1 - x0, y1 - y0, picker=False, figure=self.figure, linestyle="--", edgecolor="k",
-                          facecolor="#FFFFFF00", zorder=900, label="_rect2 for %s" % str(target))
-        self.figure.patches.append(rect1)
-        self.figure.patches.append(rect2)
-        self.targets_rects.append(rect1)
-        self.targets_rects.append(rect2)
+        # grow the extent arrays if they are full
+        if len(self.targets) > len(self.targets_extents):
+            self.targets_extents = np.concatenate((self.targets_extents, np.zeros_like(self.targets_extents)))
+            self.targets_bounds = np.concatenate((self.targets_bounds, np.zeros_like(self.targets_bounds)))
+        self.set_target_extent(len(self.targets) - 1, target.get_positions())
 
-        self.update_extent()
+        if update:
+            self.update_outlines()
+            self.update_extent()
 
-    def update_extent(self):
-        points = None
-        for target in self.targets:
-            new_points = np.array(target.get_positions())
+    def add_targets(self, targets):
+        """ add several targets, the outlines and the extent of the selection are only updated once """
+        for target in targets:
+            self.add_target(target, update=False)
+        if len(self.targets):
+            self.update_outlines()
+            self.update_extent()
 
-            if points is None:
-                points = new_points
-            else:
-                points = np.concatenate((points, new_points))
+    def set_target_extent(self, index, points):
+        """ store the extent of the outline and of all the points of the target """
+        points = np.asarray(points, dtype=float)
+        self.targets_bounds[index] = np.concatenate((np.min(points, axis=0), np.max(points, axis=0)))
+        # the outline of a text does not include its anchor
+        if points.shape[0] == 3:
+            points = points[1:]
+        self.targets_extents[index] = np.concatenate((np.min(points, axis=0), np.max(points, axis=0)))
+
+    def update_targets_extents(self, use_previous_offset=False, update_offset=False):
+        """ get the extents of all targets from their current positions """
+        for index, target in enumerate(self.targets):
+            self.set_target_extent(index, target.get_positions(use_previous_offset, update_offset=update_offset))
+
+    def update_outlines(self):
+        """ set the outlines of the targets from their extents """
+        x0, y0, x1, y1 = self.targets_extents[:len(self.targets)].T
+        outlines = np.stack((np.column_stack((x0, y0)), np.column_stack((x1, y0)), np.column_stack((x1, y1)),
+                             np.column_stack((x0, y1)), np.column_stack((x0, y0))), axis=1)
+        self.outlines.set_segments(np.repeat(outlines, 2, axis=0))
 
+    def update_extent(self):
         for grabber in self.grabbers:
             grabber.targets = self.targets
 
-        self.positions[0] = np.min(points[:, 0])
-        self.positions[1] = np.min(points[:, 1])
-        self.positions[2] = np.max(points[:, 0])
-        self.positions[3] = np.max(points[:, 1])
+        bounds = self.targets_bounds[:len(self.targets)]
+        self.positions[:2] = np.min(bounds[:, :2], axis=0)
+        self.positions[2:] = np.max(bounds[:, 2:], axis=0)
 
         if self.positions[2]-self.positions[0] < 0.01:
             self.positions[0], self.positions[2] = self.positions[0] - 0.01, self.positions[0] + 0.01
@@ -199,6 +304,7 @@ class GrabbableRectangleSelection(GrabFunctions):
                 new_points = np.array(target.get_positions())
                 new_points[:, y] += new_center - centers[index]
                 target.set_positions(new_points)
+            self.update_targets_extents()
             self.update_extent()
             self.has_moved = True
             self.end_move()
@@ -258,47 +364,23 @@ class GrabbableRectangleSelection(GrabFunctions):
         """ update the selection visualisation """
         if len(self.targets) == 0:
             return
-        if 0:
-            for index, target in enumerate(self.targets):
-                new_points = np.array(target.get_positions())
-                for i in range(2):
-                    rect = self.targets_rects[index*2+i]
-                    rect.set_xy(new_points[0])
-                    rect.set_width(new_points[1][0] - new_points[0][0])
-                    rect.set_height(new_points[1][1] - new_points[0][1])
-        else:
-            for index, target in enumerate(self.targets):
-                new_points = np.array(target.get_positions(use_previous_offset, update_offset=True))
-                if new_points.shape[0] == 3:
-                    x0, y0, x1, y1 = np.min(new_points[1:, 0]), np.min(new_points[1:, 1]), np.max(
-                        new_points[1:, 0]), np.max(
-                        new_points[1:, 1])
-                else:
-                    x0, y0, x1, y1 = np.min(new_points[:, 0]), np.min(new_points[:, 1]), np.max(
-                        new_points[:, 0]), np.max(
-                        new_points[:, 1])
-                w0, h0 = x1 - x0, y1 - y0
-                for i in range(2):
-                    rect: Rectangle = self.targets_rects[index * 2 + i]
-                    rect.set_x(x0)
-                    rect.set_y(y0)
-                    rect.set_width(w0)
-                    rect.set_height(h0)
-                    # rect.setRect(x0, y0, w0, h0)
+        self.update_targets_extents(use_previous_offset, update_offset=True)
+        self.update_outlines()
 
     def remove_target(self, target):
+        self.finish_nudge()
         targets_non_wrapped = [t.target for t in self.targets]
         if target not in targets_non_wrapped:
             return
         index = targets_non_wrapped.index(target)
         self.targets.pop(index)
-        rect1 = self.targets_rects.pop(index*2)
-        rect2 = self.targets_rects.pop(index*2)
-        self.figure.patches.remove(rect1)
-        self.figure.patches.remove(rect2)
+        count = len(self.targets)
+        self.targets_extents[index:count] = self.targets_extents[index + 1:count + 1]
+        self.targets_bounds[index:count] = self.targets_bounds[index + 1:count + 1]
         if len(self.targets) == 0:
             self.clear_targets()
         else:
+            self.update_outlines()
             self.update_extent()
 
     def update_grabber(self):
@@ -313,9 +395,8 @@ class GrabbableRectangleSelection(GrabFunctions):
             grabber.set_xy((-100, -100))
 
     def clear_targets(self):
-        for rect in self.targets_rects:
-            self.figure.patches.remove(rect)
-        self.targets_rects = []
+        self.finish_nudge()
+        self.outlines.set_segments([])
         self.targets = []
 
         self.hide_grabber()
@@ -354,35 +435,48 @@ class GrabbableRectangleSelection(GrabFunctions):
     def get_pos(self, pos):
         return self.transform(pos)
 
-    def get_save_point(self):
-        targets = [target.target for target in self.targets]
-        positions = [target.get_positions() for target in self.targets]
-
-        def undo():
-            self.clear_targets()
-            for target, pos in zip(targets, positions):
-                target = TargetWrapper(target)
-                target.set_positions(pos)
-                self.add_target(target.target)
-        return undo
-
     def start_move(self):
         self.start_p1 = self.p1.copy()
         self.start_p2 = self.p2.copy()
         self.hide_grabber()
-
-        self.store_start = self.get_save_point()
+        # the targets are only changed by the drag, so their positions can be cached until the end of the move
+        TargetWrapper.set_cache_enabled(self.figure, True)
+
+        # the points of all targets in one array, the move transforms them from their start positions
+        points = [np.asarray(target.get_positions(), dtype=float).reshape(-1, 2) for target in self.targets]
+        self.start_points = np.concatenate(points) if len(points) else np.zeros((0, 2))
+        self.start_splits = np.cumsum([len(p) for p in points], dtype=int)[:-1]
+        self.moved_points = self.start_points.copy()
+        count = len(self.targets)
+        self.start_extents = [self.targets_extents[:count].copy(), self.targets_bounds[:count].copy()]
+        self.start_inv_transform = self.get_inv_trans_matrix()
+
+        # store the positions before the edit for the undo history
+        self.start_elements = [target.target for target in self.targets]
+        self.start_counts, self.start_positions = getElementPositions(self.figure, self.start_elements)
 
     def end_move(self):
+        TargetWrapper.set_cache_enabled(self.figure, False)
+        # the extents were only transformed during the move, get them from the moved targets
+        canvas = self.figure.canvas
+        renderer = canvas.get_renderer() if hasattr(canvas, "get_renderer") else getattr(self.figure, "_cachedRenderer", None)
+        for target in self.targets:
+            # the bbox patch of a text is otherwise only moved when it is drawn
+            if isinstance(target.target, Text) and target.target.get_bbox_patch() is not None and renderer is not None:
+                target.target.update_bbox_position_size(renderer)
+        self.update_targets_extents()
+        self.update_outlines()
         self.update_grabber()
-        self.figure.canvas.draw()
+        canvas.draw()
 
-        self.store_end = self.get_save_point()
-        self.figure.change_tracker.addEdit([self.store_start, self.store_end])
+        # only add an undo step if something was moved
+        counts, positions = getElementPositions(self.figure, self.start_elements)
+        edit = PositionEdit.create(self.figure, self.start_elements, counts, self.start_positions, positions, "Move")
+        if edit is not None:
+            self.figure.change_tracker.addEdit(edit)
 
     def addOffset(self, pos, dir, keep_aspect_ratio=True):
         pos = list(pos)
-        self.old_inv_transform = self.get_inv_trans_matrix()
 
         if (keep_aspect_ratio or self.do_change_aspect_ratio()) and not (dir & DIR_X0 and dir & DIR_X1 and dir & DIR_Y0 and dir & DIR_Y1):
             if (dir & DIR_X0 and dir & DIR_Y0) or (dir & DIR_X1 and dir & DIR_Y1):
@@ -425,12 +519,21 @@ class GrabbableRectangleSelection(GrabFunctions):
         if dir & DIR_Y1:
             self.p2[1] = self.start_p2[1] + pos[1]
 
-        transform = np.dot(self.get_trans_matrix(), self.old_inv_transform)
-        for target in self.targets:
-            self.transform_target(transform, target)
-
-        for rect in self.targets_rects:
-            self.transform_target(transform, TargetWrapper(rect))
+        # the transform from the start of the move to the current selection, applied to all points at once
+        transform = np.dot(self.get_trans_matrix(), self.start_inv_transform)
+        points = self.apply_transform(transform, self.start_points)
+        # only the targets whose points changed are updated
+        for target, new, old in zip(self.targets, np.split(points, self.start_splits), np.split(self.moved_points, self.start_splits)):
+            if not np.array_equal(new, old):
+                target.set_positions(new)
+        self.moved_points = points
+
+        count = len(self.targets)
+        for extents, start_extents in zip([self.targets_extents[:count], self.targets_bounds[:count]], self.start_extents):
+            points = self.apply_transform(transform, start_extents.reshape(-1, 2)).reshape(-1, 4)
+            extents[:, :2] = np.minimum(points[:, :2], points[:, 2:])
+            extents[:, 2:] = np.maximum(points[:, :2], points[:, 2:])
+        self.update_outlines()
 
     def move(self, pos, dir, snaps, keep_aspect_ratio=False, ignore_snaps=False):
         self.addOffset(pos, dir, keep_aspect_ratio)
@@ -442,18 +545,63 @@ class GrabbableRectangleSelection(GrabFunctions):
             offx, offy = checkSnaps(self.snaps)
 
         checkSnapsActive(snaps)
+        self.snap_overlay.set_snaps(snaps)
 
-        self.figure.canvas.draw()
+        self.draw_moved()
 
-    def apply_transform(self, transform, point):
-        point = np.array(point)
-        point = np.hstack((point, np.ones((point.shape[0], 1)))).T
-        return np.dot(transform, point)[:2].T
+    def draw_moved(self):
+        """ draw the moved elements, by blitting them if the canvas supports it """
+        if self.background is None:
+            self.start_blit()
+        if self.background is not None:
+            self.blit()
+        else:
+            self.figure.canvas.draw()
 
-    def transform_target(self, transform, target):
-        points = target.get_positions()
-        points = self.apply_transform(transform, points)
-        target.set_positions(points)
+    def start_blit(self):
+        """ draw the figure without the moved elements and store it as the background for blitting """
+        canvas = self.figure.canvas
+        if not getattr(canvas, "supports_blit", False):
+            return
+        self.animated_artists = []
+        for target in self.targets:
+            # axis labels are drawn by their axis, therefore the whole axes has to be redrawn
+            axes = checkXLabel(target.target) or checkYLabel(target.target)
+            artist = axes if axes is not None else target.target
+            if artist not in self.animated_artists:
+                self.animated_artists.append(artist)
+        self.animated_artists += [self.outlines, self.snap_overlay.collection]
+        for grabber in self.grabbers:
+            self.animated_artists.append(grabber)
+            if getattr(grabber, "rect", None) is not None:
+                self.animated_artists.append(grabber.rect)
+        # the grabbers are always animated, every artist gets its own state back at the end
+        self.animated_states = [artist.get_animated() for artist in self.animated_artists]
+        for artist in self.animated_artists:
+            artist.set_animated(True)
+        canvas.draw()
+        self.background = canvas.copy_from_bbox(self.figure.bbox)
+
+    def blit(self):
+        """ restore the background and draw only the moved elements on top of it """
+        canvas = self.figure.canvas
+        canvas.restore_region(self.background)
+        for artist in sorted(self.animated_artists, key=lambda artist: artist.get_zorder()):
+            self.figure.draw_artist(artist)
+        canvas.blit(self.figure.bbox)
+
+    def end_blit(self):
+        """ return to drawing the moved elements with the figure """
+        if self.background is None:
+            return
+        for artist, animated in zip(self.animated_artists, self.animated_states):
+            artist.set_animated(animated)
+        self.animated_artists = None
+        self.animated_states = None
+        self.background = None
+
+    def apply_transform(self, transform, points):
+        return np.dot(points, transform[:2, :2].T) + transform[:2, 2]
 
     def keyPressEvent(self, event):
         #if not self.selected:
@@ -469,40 +617,346 @@ class GrabbableRectangleSelection(GrabFunctions):
                 target.target.set_zorder(target.target.get_zorder() + 1)
                 self.figure.change_tracker.addChange(target.target, ".set_zorder(%d)" % target.target.get_zorder())
             self.figure.canvas.draw()
-        if event.key == 'left':
-            self.start_move()
-            self.addOffset((-1, 0), self.dir)
-            self.end_move()
-        if event.key == 'right':
-            self.start_move()
-            self.addOffset((+1, 0), self.dir)
-            self.end_move()
-        if event.key == 'down':
-            self.start_move()
-            self.addOffset((0, -1), self.dir)
-            self.end_move()
-        if event.key == 'up':
-            self.start_move()
-            self.addOffset((0, +1), self.dir)
-            self.end_move()
+        if event.key in self.nudge_keys:
+            self.nudge(event.key)
         if event.key == "delete":
             for target in self.targets[::-1]:
                 self.figure.change_tracker.removeElement(target.target)
             self.figure.canvas.draw()
         #print("event", event.key)
 
+    def nudge(self, key):
+        """ move the targets with the arrow keys, the nudges until a pause of nudge_timeout are one undo step """
+        if len(self.targets) == 0:
+            return
+        dx, dy = self.nudge_keys[key]
+        step = self.nudge_step_shift if key.startswith("shift+") else self.nudge_step
+        if self.nudge_offset is None:
+            self.start_move()
+            self.nudge_offset = np.zeros(2)
+        self.nudge_offset += (dx * step, dy * step)
+        self.addOffset(self.nudge_offset, self.dir)
+        self.draw_moved()
+
+        # restart the timer that finishes the nudging
+        if self.nudge_timer is not None:
+            self.nudge_timer.stop()
+        timer = self.figure.canvas.new_timer(interval=int(self.nudge_timeout * 1000))
+        if type(timer) is TimerBase:
+            self.nudge_timer = None
+            return self.finish_nudge()
+        timer.single_shot = True
+        timer.add_callback(self.finish_nudge)
+        self.nudge_timer = timer
+        timer.start()
+
+    def finish_nudge(self):
+        """ end the current nudging and add it as one undo step """
+        if self.nudge_timer is not None:
+            self.nudge_timer.stop()
+            self.nudge_timer = None
+        if self.nudge_offset is None:
+            return
+        self.nudge_offset = None
+        self.end_blit()
+        self.end_move()
+
+
+class PointIndex:
+    """ the points of a large line or scatter in data coordinates sorted by x
+
+    The points (and for lines the segments) close to a click are found with a binary search, only those are tested.
+    """
+
+    def __init__(self, data, segments=False):
+        self.data = data
+        points = np.asarray(data, dtype=float).reshape(-1, 2)
+        self.order = np.argsort(points[:, 0], kind="stable")
+        self.x = points[self.order, 0]
+        self.points = points
+        finite = points[np.all(np.isfinite(points), axis=1)]
+        self.bounds = np.concatenate((finite.min(axis=0), finite.max(axis=0))) if len(finite) else None
+        self.segments = None
+        if segments and len(points) > 1:
+            start, end = points[:-1], points[1:]
+            x0 = np.fmin(start[:, 0], end[:, 0])
+            width = np.abs(end[:, 0] - start[:, 0])
+            self.segments = np.argsort(x0, kind="stable")
+            self.segments_x = x0[self.segments]
+            # segments with a nan point are never drawn
+            self.segments_width = np.nanmax(width) if np.any(np.isfinite(width)) else 0
+
+    def queryPoints(self, x0, x1, y0, y1):
+        """ the indices of the points in the rectangle """
+        index = self.order[np.searchsorted(self.x, x0, side="left"):np.searchsorted(self.x, x1, side="right")]
+        y = self.points[index, 1]
+        return index[(y0 <= y) & (y <= y1)]
+
+    def querySegments(self, x0, x1, y0, y1):
+        """ the indices of the segments (start points) whose bounding box overlaps the rectangle """
+        index = self.segments[np.searchsorted(self.segments_x, x0 - self.segments_width, side="left"):
+                              np.searchsorted(self.segments_x, x1, side="right")]
+        start, end = self.points[index], self.points[index + 1]
+        overlap = (np.fmax(start[:, 0], end[:, 0]) >= x0) & (np.fmax(start[:, 1], end[:, 1]) >= y0) & \
+                  (np.fmin(start[:, 1], end[:, 1]) <= y1)
+        return index[overlap]
+
+
+def segmentDistances(point, start, end):
+    """ the distances of a point to the line segments from start to end """
+    direction = end - start
+    length = np.sum(direction ** 2, axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        t = np.clip(np.sum((point - start) * direction, axis=1) / length, 0, 1)
+    t[length == 0] = 0
+    return np.hypot(*(start + t[:, None] * direction - point).T)
+
+
+def markerScales(transforms):
+    """ an upper bound of the scaling of each of the marker transforms, exact for the scaling by the marker sizes """
+    matrices = np.abs(transforms[:, :2, :2])
+    return np.sqrt(np.max(np.sum(matrices, axis=1), axis=1) * np.max(np.sum(matrices, axis=2), axis=1))
+
+
+class PickIndex:
+    """ a uniform grid of the window extents of the pickable artists, to only test the artists close to a click
+
+    The index is rebuilt lazily at the first click after the figure was drawn.
+    """
+    # the number of grid cells in each direction
+    cells = 32
+    # the distance in points around the extent of an artist in which it can still contain a click, lines and
+    # collections use at least their pick radius and line width
+    margin = 10
+    # lines and scatters with more points are tested with a PointIndex instead of their contains method
+    large_artist_points = 10000
+    # the number of markers that are tested at once when confirming a click on a large scatter
+    confirm_markers = 256
+
+    def __init__(self, figure):
+        self.figure = figure
+        self.artists = None
+        # the point indices are in data coordinates, therefore they stay valid until the data of the artist changes
+        self.point_indices = weakref.WeakKeyDictionary()
+        self.marker_extents = weakref.WeakKeyDictionary()
+        self.figure.canvas.mpl_connect('draw_event', self.invalidate)
+
+    def invalidate(self, event=None):
+        self.artists = None
+
+    def getPointIndex(self, artist):
+        """ the PointIndex of a large line or scatter, or None if the artist should be tested by its contains method """
+        if isinstance(artist, Line2D):
+            if artist.get_drawstyle().startswith("steps"):
+                return None
+            data = artist.get_xydata()
+            transform = artist.get_transform()
+        elif isinstance(artist, PathCollection):
+            # the markers are tested in display coordinates, which needs an affine transform of their paths
+            if not artist.get_transform().is_affine:
+                return None
+            data = artist.get_offsets()
+            transform = artist.get_offset_transform()
+        else:
+            return None
+        # only separable transforms map a rectangle around the click to a rectangle in data coordinates
+        if len(data) < self.large_artist_points or not transform.is_separable:
+            return None
+        point_index = self.point_indices.get(artist)
+        if point_index is None or point_index.data is not data:
+            point_index = PointIndex(data, segments=isinstance(artist, Line2D) and artist.get_linestyle() not in ["None", None])
+            self.point_indices[artist] = point_index
+        return point_index, transform
+
+    def getCollectionPickRadius(self, artist):
+        picker = artist.get_picker()
+        return float(picker) if isinstance(picker, Number) and picker is not True else artist.get_pickradius()
+
+    def getPickRadius(self, artist, index=None):
+        """ the distance in pixels from a point of the artist (all or the given points) within which it can contain a
+        click, for scatters this includes the furthest vertex of the marker """
+        if isinstance(artist, Line2D):
+            return self.figure.dpi / 72. * artist.get_pickradius()
+        # the outlines of the markers are tested as strokes of width 2 * radius, whose miter joins extend up to 4 times
+        # the radius at sharp corners (the miter limit of agg)
+        radius = 4 * abs(self.getCollectionPickRadius(artist))
+        paths = artist.get_paths()
+        transforms = artist.get_transforms()
+        if len(paths) == 0 or len(transforms) == 0:
+            return radius
+        # the size of the marker paths and their scaling only change with the markers or their sizes
+        cached = self.marker_extents.get(artist)
+        if cached is None or cached[0] is not paths or cached[1] is not transforms:
+            extent = max(np.max(np.hypot(*path.vertices.T)) if len(path.vertices) else 0 for path in paths)
+            scales = markerScales(transforms)
+            cached = (paths, transforms, extent * scales, extent * np.max(scales))
+            self.marker_extents[artist] = cached
+        if index is None:
+            return radius + cached[3]
+        return radius + cached[2][index % len(cached[2])]
+
+    def queryCandidates(self, artist, point_index, transform, event):
+        """ the indices of the points (or segment starts) of a large artist that are close enough to the click """
+        radius = self.getPickRadius(artist)
+        # the rectangle around the click in data coordinates
+        corners = transform.inverted().transform([[event.x - radius, event.y - radius], [event.x + radius, event.y + radius]])
+        x0, y0 = np.nanmin(corners, axis=0)
+        x1, y1 = np.nanmax(corners, axis=0)
+        point = np.array([event.x, event.y])
+        if point_index.segments is not None:
+            index = point_index.querySegments(x0, x1, y0, y1)
+            start = transform.transform(point_index.points[index])
+            end = transform.transform(point_index.points[index + 1])
+            return index[segmentDistances(point, start, end) <= radius]
+        index = point_index.queryPoints(x0, x1, y0, y1)
+        points = transform.transform(point_index.points[index])
+        return index[np.hypot(*(points - point).T) <= self.getPickRadius(artist, index)]
+
+    def contains(self, artist, event):
+        """ test if the artist can contain the click, for large artists only the points close to the click are tested
+
+        For lines this is the same test as their contains method. The markers of scatters are only tested by their
+        distance, an artist that is picked by it has to be confirmed with confirm().
+        """
+        point_index = self.getPointIndex(artist)
+        if point_index is None:
+            return artist.contains(event)[0]
+        point_index, transform = point_index
+        return len(self.queryCandidates(artist, point_index, transform, event)) > 0
+
+    def confirm(self, artist, event):
+        """ the exact test of an artist for which contains() was True, only the markers close to the click are tested
+        by the contains method of a collection of just these markers """
+        point_index = self.getPointIndex(artist)
+        if point_index is None or not isinstance(artist, PathCollection):
+            return True
+        point_index, transform = point_index
+        index = self.queryCandidates(artist, point_index, transform, event)
+        points = transform.transform(point_index.points[index])
+        # the closest markers are tested first, as they decide most clicks
+        order = np.argsort(np.hypot(*(points - np.array([event.x, event.y])).T))
+        paths = artist.get_paths()
+        sizes = artist.get_sizes()
+        for start in range(0, len(order), self.confirm_markers):
+            part = index[order[start:start + self.confirm_markers]]
+            part_paths = [paths[i % len(paths)] for i in part] if len(paths) > 1 else paths
+            part_sizes = sizes[part % len(sizes)] if len(sizes) > 1 else sizes
+            # the markers are placed in display coordinates, with the sizes scaled as the scatter does when drawn
+            markers = PathCollection(part_paths)
+            markers.set_sizes(part_sizes, self.figure.dpi)
+            markers.set_offsets(transform.transform(point_index.points[part]))
+            markers.set_transform(artist.get_transform())
+            markers.set_pickradius(self.getCollectionPickRadius(artist))
+            if markers.contains(event)[0]:
+                return True
+        return False
+
+    def getExtent(self, artist, renderer):
+        """ the window extent of the artist or nan if it is unknown, then the artist is tested for every click """
+        point_index = self.getPointIndex(artist)
+        if point_index is not None:
+            # the extent of a large artist from the bounds of its data instead of transforming all its points
+            point_index, transform = point_index
+            if point_index.bounds is None:
+                return [np.nan] * 4
+            corners = transform.transform(point_index.bounds.reshape(2, 2))
+            radius = self.getPickRadius(artist)
+            return list(np.min(corners, axis=0) - radius) + list(np.max(corners, axis=0) + radius)
+        try:
+            bbox = artist.get_window_extent(renderer)
+            if isinstance(artist, Text) and artist.get_bbox_patch() is not None:
+                bbox = Bbox.union([bbox, artist.get_bbox_patch().get_window_extent(renderer)])
+        except Exception:
+            return [np.nan] * 4
+        extent = [bbox.x0, bbox.y0, bbox.x1, bbox.y1]
+        if not np.all(np.isfinite(extent)) or (bbox.width <= 0 and bbox.height <= 0):
+            return [np.nan] * 4
+        return extent
+
+    def build(self):
+        canvas = self.figure.canvas
+        renderer = canvas.get_renderer() if hasattr(canvas, "get_renderer") else getattr(self.figure, "_cachedRenderer", None)
+
+        # the pickable artists in the order in which the picking visits them
+        self.artists = []
+
+        def add_children(element):
+            for child in sorted(element.get_children(), key=lambda x: x.get_zorder()):
+                if child.get_visible() and (child.pickable() or isinstance(child, GrabberGeneric)) and not (child.get_label() is not None and child.get_label().startswith("_")):
+                    self.artists.append(child)
+                add_children(child)
+        add_children(self.figure)
+
+        self.extents = np.array([self.getExtent(artist, renderer) for artist in self.artists], dtype=float).reshape(-1, 4)
+        margins = np.array([self.getMargin(artist) for artist in self.artists], dtype=float).reshape(-1, 1)
+        self.extents[:, :2] -= margins
+        self.extents[:, 2:] += margins
+
+        # the artists with an unknown extent are candidates in every cell
+        unknown = np.any(np.isnan(self.extents), axis=1)
+        self.everywhere = list(np.flatnonzero(unknown))
+        self.grid = [[] for i in range(self.cells * self.cells)]
+        for index in np.flatnonzero(~unknown):
+            cx0, cy0 = self.getCell(*self.extents[index, :2])
+            cx1, cy1 = self.getCell(*self.extents[index, 2:])
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    self.grid[cx * self.cells + cy].append(index)
+
+    def getMargin(self, artist):
+        """ the distance in pixels around the extent of an artist in which it can still contain a click """
+        scale = max(self.figure.dpi / 72., 1)
+        margin = self.margin * scale
+        if isinstance(artist, (Line2D, Collection)):
+            radius = artist.get_pickradius() if isinstance(artist, Line2D) else self.getCollectionPickRadius(artist)
+            linewidth = np.max(artist.get_linewidth()) if np.size(artist.get_linewidth()) else 0
+            margin = max(margin, (abs(radius) + linewidth) * scale)
+        return margin
+
+    def getCell(self, x, y):
+        width, height = self.figure.bbox.size
+        cx = int(np.clip(np.floor(x / width * self.cells), 0, self.cells - 1))
+        cy = int(np.clip(np.floor(y / height * self.cells), 0, self.cells - 1))
+        return cx, cy
+
+    def query(self, x, y):
+        """ the artists whose extent contains the point, in the order of picking """
+        if self.artists is None:
+            self.build()
+        cx, cy = self.getCell(x, y)
+        candidates = []
+        for index in sorted(self.grid[cx * self.cells + cy] + self.everywhere):
+            x0, y0, x1, y1 = self.extents[index]
+            if np.isnan(x0) or (x0 <= x <= x1 and y0 <= y <= y1):
+                candidates.append(self.artists[index])
+        return candidates
+
+    def intersecting(self, x0, y0, x1, y1):
+        """ the artists whose extent intersects the rectangle, in the order of picking """
+        if self.artists is None:
+            self.build()
+        extents = self.extents + [self.margin, self.margin, -self.margin, -self.margin]
+        with np.errstate(invalid="ignore"):
+            intersects = (extents[:, 0] <= x1) & (extents[:, 2] >= x0) & (extents[:, 1] <= y1) & (extents[:, 3] >= y0)
+        return [self.artists[index] for index in np.flatnonzero(intersects)]
+
 
 class DragManager:
     selected_element = None
     grab_element = None
 
-    def __init__(self, figure):
+    def __init__(self, figure, grid=None, xguides=None, yguides=None, unit="cm"):
         self.figure = figure
         self.figure.figure_dragger = self
 
         self.figure.canvas.mpl_disconnect(self.figure.canvas.manager.key_press_handler_id)
 
         self.activate()
+        self.pick_index = PickIndex(figure)
+
+        # the change tracker is created first, as it might restore new elements from the journal
+        self.change_tracker = ChangeTracker(figure)
+        self.figure.change_tracker = self.change_tracker
 
         # make all the subplots pickable
         for index, axes in enumerate(self.figure.axes):
@@ -525,40 +979,49 @@ class DragManager:
 
         self.selection = GrabbableRectangleSelection(figure)
         self.figure.selection = self.selection
-        self.change_tracker = ChangeTracker(figure)
-        self.figure.change_tracker = self.change_tracker
+
+        # the grid and the guide lines that the dragged elements snap to
+        self.guides = Guides(figure, grid, xguides, yguides, unit)
+        self.figure.guides = self.guides
+
+        # the rectangle that is dragged on the empty canvas to select all elements it touches
+        self.marquee = Rectangle((0, 0), 0, 0, transform=IdentityTransform(), visible=False, zorder=1000, linestyle="--",
+                                 edgecolor="k", facecolor=(0, 0, 1, 0.1), label="_tmp_snap")
+        self.figure.add_artist(self.marquee)
+        self.marquee_start = None
 
     def make_dragable(self, target):
         target.set_picker(True)
         if isinstance(target, Text):
             target.set_bbox(dict(facecolor="none", edgecolor="none"))
 
-    def get_picked_element(self, event, element=None, picked_element=None, last_selected=None):
-        # start with the figure
-        if element is None:
-            element = self.figure
-        finished = False
-        # iterate over all children
-        for child in sorted(element.get_children(), key=lambda x: x.get_zorder()):
-            # check if the element is contained in the event and has an active dragger
-            #if child.contains(event)[0] and ((getattr(child, "_draggable", None) and getattr(child, "_draggable",
-            #                                                                               None).connected) or isinstance(child, GrabberGeneric) or isinstance(child, GrabbableRectangleSelection)):
-            if child.get_visible() and child.contains(event)[0] and (child.pickable() or isinstance(child, GrabberGeneric)) and not (child.get_label() is not None and child.get_label().startswith("_")):
+    def get_picked_element(self, event, last_selected=None):
+        # the elements that contain the click, large scatters are only confirmed when they would be picked
+        picked_elements = []
+
+        def get_confirmed():
+            while len(picked_elements):
+                if self.pick_index.confirm(picked_elements[-1], event):
+                    return picked_elements[-1]
+                picked_elements.pop()
+            return None
+
+        # only the pickable elements with an extent close to the click are tested, in the order of the artist tree
+        for child in self.pick_index.query(event.x, event.y):
+            if self.pick_index.contains(child, event):
                 # if the element is the last selected, finish the search
-                if child == last_selected:
-                    return picked_element, True
+                if child == last_selected and self.pick_index.confirm(child, event):
+                    return get_confirmed(), True
                 # use this element as the current best matching element
-                picked_element = child
-            # iterate over the children's children
-            picked_element, finished = self.get_picked_element(event, child, picked_element, last_selected=last_selected)
-            # if the subcall wants to finish, just break the loop
-            if finished:
-                break
-        return picked_element, finished
+                picked_elements.append(child)
+        return get_confirmed(), False
 
     def button_release_event0(self, event):
+        # finish the selection rectangle
+        if self.marquee_start is not None:
+            self.end_marquee(event)
         # release the grabber
-        if self.grab_element:
+        elif self.grab_element:
             self.grab_element.button_release_event(event)
             self.grab_element = None
         # or notify the selected element
@@ -566,6 +1029,7 @@ class DragManager:
             self.selection.button_release_event(event)
 
     def button_press_event0(self, event):
+        self.selection.finish_nudge()
         if event.button == 1:
             last = self.selection.targets[-1] if len(self.selection.targets) else None
             contained = np.any([t.target.contains(event)[0] for t in self.selection.targets])
@@ -580,6 +1044,9 @@ class DragManager:
             elif len(self.selection.targets) == 0 or not contained or event.dblclick:
                 self.select_element(picked_element, event)
                 contained = True
+                # a click on the empty canvas starts a selection rectangle
+                if picked_element is None:
+                    return self.start_marquee(event)
 
             # if we have a grabber, notify it
             if self.grab_element:
@@ -588,6 +1055,59 @@ class DragManager:
             elif contained:
                 self.selection.button_press_event(event)
 
+    def start_marquee(self, event):
+        """ start to drag a rectangle that selects all elements it touches """
+        self.marquee_start = (event.x, event.y)
+        self.marquee_background = None
+        self.marquee_motion = MotionCoalescer(self.figure.canvas, self.move_marquee)
+        self.c_marquee = self.figure.canvas.mpl_connect('motion_notify_event', self.marquee_motion.put)
+
+    def move_marquee(self, event):
+        x0, y0 = self.marquee_start
+        self.marquee.set_bounds(x0, y0, event.x - x0, event.y - y0)
+        self.marquee.set_visible(True)
+        canvas = self.figure.canvas
+        # draw the figure once without the rectangle and then only blit the rectangle
+        if self.marquee_background is None and getattr(canvas, "supports_blit", False):
+            self.marquee.set_animated(True)
+            canvas.draw()
+            self.marquee_background = canvas.copy_from_bbox(self.figure.bbox)
+        if self.marquee_background is not None:
+            canvas.restore_region(self.marquee_background)
+            self.figure.draw_artist(self.marquee)
+            canvas.blit(self.figure.bbox)
+        else:
+            canvas.draw()
+
+    def end_marquee(self, event):
+        """ select all pickable elements whose extent intersects the rectangle """
+        self.figure.canvas.mpl_disconnect(self.c_marquee)
+        self.marquee_motion.clear()
+        x0, y0 = self.marquee_start
+        x1, y1 = event.x, event.y
+        self.marquee_start = None
+        self.marquee_background = None
+        self.marquee.set_animated(False)
+        if not self.marquee.get_visible():
+            return
+        self.marquee.set_visible(False)
+
+        selected = [target.target for target in self.selection.targets]
+        selected_axes = [element for element in selected if isinstance(element, Axes)]
+        elements = []
+        for element in self.pick_index.intersecting(min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)):
+            if isinstance(element, GrabberGeneric) or element in selected:
+                continue
+            if isinstance(element, Axes):
+                selected_axes.append(element)
+            elements.append(element)
+        # the elements of a selected axes already move with the axes
+        elements = [element for element in elements if isinstance(element, Axes) or element.axes not in selected_axes]
+        self.selection.add_targets(elements)
+        if len(elements):
+            self.selected_element = elements[-1]
+        self.figure.canvas.draw()
+
     def select_element(self, element, event=None):
         # do nothing if it is already selected
         if element == self.selected_element:
@@ -611,6 +1131,9 @@ class DragManager:
             self.selection.add_target(element)
 
     def key_press_event(self, event):
+        # other keys finish the nudging with the arrow keys first, e.g. that it can be undone
+        if event.key not in self.selection.nudge_keys and event.key not in ["shift", "control", "alt"]:
+            self.selection.finish_nudge()
         # space: print code to restore current configuration
         if event.key == 'ctrl+s':
             self.figure.change_tracker.save()
@@ -20,6 +20,9 @@
 # along with Pylustrator. If not, see <http://www.gnu.org/licenses/>
 
 from __future__ import division
+import linecache
+import os
+import sys
 import matplotlib.pyplot as plt
 from matplotlib.text import Text
 import numpy as np
@@ -457,4 +460,42 @@ def main_figure(artist):
     if artist.figure == artist:
         return artist
     else:
-        return main_figure(artist.figure)
\ No newline at end of file
+        return main_figure(artist.figure)
+
+
+class EntryPoint:
+    """ the position in the user's script from where pylustrator was started, similar to traceback.FrameSummary
+
+    The source line is only read when it is accessed.
+    """
+
+    def __init__(self, filename, lineno, name):
+        self.filename = filename
+        self.lineno = lineno
+        self.name = name
+
+    @property
+    def line(self):
+        return linecache.getline(self.filename, self.lineno).strip()
+
+    def __repr__(self):
+        return "<EntryPoint %s line %s in %s>" % (self.filename, self.lineno, self.name)
+
+
+# the frames of the modules of these packages are skipped when looking for the entry point
+entry_point_ignored_packages = ("pylustrator", "matplotlib")
+
+
+def getEntryPoint():
+    """ get the innermost frame of the call stack that is not part of pylustrator or matplotlib
+
+    The frames are identified by the name of their module, so scripts that are stored in the pylustrator directory
+    are still found.
+    """
+    frame = sys._getframe(1)
+    while frame is not None:
+        module = frame.f_globals.get("__name__", "")
+        if module.split(".", 1)[0] not in entry_point_ignored_packages:
+            return EntryPoint(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    raise RuntimeError("pylustrator could not find the script that called it in the call stack")
@@ -19,20 +19,26 @@
 # You should have received a copy of the GNU General Public License
 # along with Pylustrator. If not, see <http://www.gnu.org/licenses/>
 
-import matplotlib.pyplot as plt
 import numpy as np
-from matplotlib.lines import Line2D
+from matplotlib.collections import LineCollection
+from matplotlib.transforms import IdentityTransform
 from matplotlib.axes import Axes
 from matplotlib.patches import Rectangle, Ellipse, FancyArrowPatch
 from matplotlib.text import Text
 from matplotlib.legend import Legend
 import matplotlib as mpl
 
+from .change_tracker import ChangeRecord
+from .helper_functions import main_figure
+
 DIR_X0 = 1
 DIR_Y0 = 2
 DIR_X1 = 4
 DIR_Y1 = 8
 
+# the distance in pixels at which an element snaps
+snap_distance = 10
+
 
 def get_loc_in_canvas(legend):
     offsetbox = legend._legend_box
@@ -44,15 +50,35 @@ def get_loc_in_canvas(legend):
     return loc_in_canvas
 
 
+def getLabelAxes(figure):
+    """ get a dict that maps the axis labels of the figure to their axes and "x" or "y"
+
+    The dict is stored in the figure and rebuilt when axes are added or removed.
+    """
+    label_axes = getattr(figure, "_pylustrator_label_axes", None)
+    if label_axes is None:
+        label_axes = {}
+        for axes in figure.axes:
+            label_axes.setdefault(axes.xaxis.get_label(), (axes, "x"))
+            label_axes.setdefault(axes.yaxis.get_label(), (axes, "y"))
+        # subfigures do not notify about changes of their axes, therefore the dict is only stored for figures
+        if getattr(figure, "add_axobserver", None) is not None:
+            if not getattr(figure, "_pylustrator_label_observer", False):
+                figure.add_axobserver(lambda fig: setattr(fig, "_pylustrator_label_axes", None))
+                figure._pylustrator_label_observer = True
+            figure._pylustrator_label_axes = label_axes
+    return label_axes
+
+
 def checkXLabel(target):
-    for axes in target.figure.axes:
-        if axes.xaxis.get_label() == target:
-            return axes
+    axes, axis = getLabelAxes(target.figure).get(target, (None, None))
+    if axis == "x":
+        return axes
 
 def checkYLabel(target):
-    for axes in target.figure.axes:
-        if axes.yaxis.get_label() == target:
-            return axes
+    axes, axis = getLabelAxes(target.figure).get(target, (None, None))
+    if axis == "y":
+        return axes
 
 
 class TargetWrapper(object):
@@ -61,6 +87,7 @@ class TargetWrapper(object):
     def __init__(self, target):
         self.target = target
         self.figure = target.figure
+        self.main_figure = main_figure(target)
         self.do_scale = True
         self.fixed_aspect = False
         if isinstance(self.target, mpl.patches.Patch):
@@ -89,8 +116,29 @@ class TargetWrapper(object):
             self.get_transform = self.target.get_transform
             self.do_scale = False
 
+    @staticmethod
+    def set_cache_enabled(figure, enabled):
+        """ enable or disable the caching of the positions of the figure's artists, e.g. during a drag when only
+        set_positions changes them, enabling it again discards the cached positions of the figure """
+        figure._pylustrator_cache_id = object() if enabled else None
+
+    def get_cache_id(self):
+        return getattr(self.main_figure, "_pylustrator_cache_id", None)
+
+    def get_cache_key(self):
+        # the positions of the artists in an axes change when the axes is moved
+        axes = getattr(self.target, "axes", None)
+        return (self.get_cache_id(), getattr(axes, "_pylustrator_cache_version", 0), self.figure.dpi,
+                tuple(self.figure.get_size_inches()))
+
     def get_positions(self, use_previous_offset=False, update_offset=False) -> (int, int, int, int):
         """ get the current position of the target Artist """
+        # only the plain positions are cached, as the other calls update the offset of texts and legends
+        use_cache = self.get_cache_id() is not None and not use_previous_offset and not update_offset
+        if use_cache:
+            cached = getattr(self.target, "_pylustrator_cached_positions", None)
+            if cached is not None and cached[0] == self.get_cache_key():
+                return cached[1].copy()
         points = []
         if isinstance(self.target, Rectangle):
             points.append(self.target.get_xy())
@@ -150,9 +198,16 @@ class TargetWrapper(object):
             else:
                 if getattr(self.target, "_pylustrator_offset", None) is None or update_offset:
                     self.target._pylustrator_offset = points[1] - points[0]
-        return self.transform_points(points)
+        points = self.transform_points(points)
+        if use_cache:
+            self.target._pylustrator_cached_positions = (self.get_cache_key(), points.copy())
+        return points
 
     def set_positions(self, points):
+        self.target._pylustrator_cached_positions = None
+        # moving an axes also moves the artists inside of it
+        if isinstance(self.target, Axes):
+            self.target._pylustrator_cache_version = getattr(self.target, "_pylustrator_cache_version", 0) + 1
         points = self.transform_inverted_points(points)
 
         if isinstance(self.target, Rectangle):
@@ -160,52 +215,52 @@ class TargetWrapper(object):
             self.target.set_width(points[1][0] - points[0][0])
             self.target.set_height(points[1][1] - points[0][1])
             if self.target.get_label() is None or not self.target.get_label().startswith("_rect"):
-                self.figure.change_tracker.addChange(self.target, ".set_xy([%f, %f])" % tuple(self.target.get_xy()))
-                self.figure.change_tracker.addChange(self.target, ".set_width(%f)" % self.target.get_width())
-                self.figure.change_tracker.addChange(self.target, ".set_height(%f)" % self.target.get_height())
+                self.figure.change_tracker.addChange(self.target, ChangeRecord(".set_xy", [list(self.target.get_xy())]))
+                self.figure.change_tracker.addChange(self.target, ChangeRecord(".set_width", [self.target.get_width()]))
+                self.figure.change_tracker.addChange(self.target, ChangeRecord(".set_height", [self.target.get_height()]))
         elif isinstance(self.target, Ellipse):
             self.target.center = np.mean(points, axis=0)
             self.target.width = points[1][0] - points[0][0]
             self.target.height = points[1][1] - points[0][1]
-            self.figure.change_tracker.addChange(self.target, ".center = (%f, %f)" % tuple(self.target.center))
-            self.figure.change_tracker.addChange(self.target, ".width = %f" % self.target.width)
-            self.figure.change_tracker.addChange(self.target, ".height = %f" % self.target.height)
+            self.figure.change_tracker.addChange(self.target, ChangeRecord(".center", [tuple(self.target.center)], assign=True))
+            self.figure.change_tracker.addChange(self.target, ChangeRecord(".width", [self.target.width], assign=True))
+            self.figure.change_tracker.addChange(self.target, ChangeRecord(".height", [self.target.height], assign=True))
         elif isinstance(self.target, FancyArrowPatch):
             self.target.set_positions(points[0], points[1])
-            self.figure.change_tracker.addChange(self.target, ".set_positions(%s, %s)" % (tuple(points[0]), tuple(points[1])))
+            # the end points are in data coordinates, which need the full precision (e.g. on log scaled axes)
+            self.figure.change_tracker.addChange(self.target, ChangeRecord(".set_positions", [tuple(points[0]), tuple(points[1])],
+                                                                           float_format="%s"))
         elif isinstance(self.target, Text):
             if checkXLabel(self.target):
                 axes = checkXLabel(self.target)
                 axes.xaxis.labelpad = -(points[0][1]-self.target.pad_offset)/self.label_factor
-                self.figure.change_tracker.addChange(axes,
-                                                     ".xaxis.labelpad = %f" % axes.xaxis.labelpad)
+                self.figure.change_tracker.addChange(axes, ChangeRecord(".xaxis.labelpad", [axes.xaxis.labelpad], assign=True))
 
                 self.target.set_position(points[0])
                 self.label_y = points[0][1]
             elif checkYLabel(self.target):
                 axes = checkYLabel(self.target)
                 axes.yaxis.labelpad = -(points[0][0]-self.target.pad_offset)/self.label_factor
-                self.figure.change_tracker.addChange(axes,
-                                                     ".yaxis.labelpad = %f" % axes.yaxis.labelpad)
+                self.figure.change_tracker.addChange(axes, ChangeRecord(".yaxis.labelpad", [axes.yaxis.labelpad], assign=True))
 
                 self.target.set_position(points[0])
                 self.label_x = points[0][0]
             else:
                 self.target.set_position(points[0])
-                self.figure.change_tracker.addChange(self.target, ".set_position([%f, %f])" % self.target.get_position())
+                self.figure.change_tracker.addChange(self.target, ChangeRecord(".set_position", [list(self.target.get_position())]))
                 if getattr(self.target, "xy", None) is not None:
                     self.target.xy = points[1]
-                    self.figure.change_tracker.addChange(self.target, ".xy = (%f, %f)" % tuple(self.target.xy))
+                    self.figure.change_tracker.addChange(self.target, ChangeRecord(".xy", [tuple(self.target.xy)], assign=True))
         elif isinstance(self.target, Legend):
             point = self.target.axes.transAxes.inverted().transform(self.transform_inverted_points(points)[0])
             self.target._loc = tuple(point)
-            self.figure.change_tracker.addChange(self.target, "._set_loc((%f, %f))" % tuple(point))
+            self.figure.change_tracker.addChange(self.target, ChangeRecord("._set_loc", [tuple(point)]))
         elif isinstance(self.target, Axes):
             position = np.array([points[0], points[1]-points[0]]).flatten()
             if self.fixed_aspect:
                 position[3] = position[2]*self.target.get_position().height/self.target.get_position().width
             self.target.set_position(position)
-            self.figure.change_tracker.addChange(self.target, ".set_position([%f, %f, %f, %f])" % tuple(np.array([points[0], points[1]-points[0]]).flatten()))
+            self.figure.change_tracker.addChange(self.target, ChangeRecord(".set_position", [np.array([points[0], points[1]-points[0]]).flatten()]))
 
     def get_extent(self):
         points = np.array(self.get_positions())
@@ -215,21 +270,47 @@ class TargetWrapper(object):
                 np.max(points[:, 1])]
 
     def transform_points(self, points):
-        transform = self.get_transform()
-        return [transform.transform(p) for p in points]
+        return self.get_transform().transform(np.asarray(points, dtype=float).reshape(-1, 2))
 
     def transform_inverted_points(self, points):
-        transform = self.get_transform()
-        return [transform.inverted().transform(p) for p in points]
+        return self.get_transform().inverted().transform(np.asarray(points, dtype=float).reshape(-1, 2))
+
+class SnapOverlay:
+    """ draws the lines of all active snaps with one LineCollection in display coordinates """
+
+    def __init__(self, figure):
+        self.collection = LineCollection([], transform=IdentityTransform(), clip_on=False, linewidths=1, zorder=100,
+                                         linestyles="dashed", colors="r", label="_tmp_snap")
+        figure.add_artist(self.collection)
+
+    def set_snaps(self, snaps):
+        lines = []
+        for snap in snaps:
+            lines.extend(snap.getLines())
+        self.collection.set_segments(lines)
+
+    def clear(self):
+        self.collection.set_segments([])
+
+
+class snapBase(object):
+    """ a snap of a source target to another target, its line is drawn by the SnapOverlay """
 
-class snapBase(Line2D):
     def __init__(self, ax_source, ax_target, edge):
         self.ax_source = TargetWrapper(ax_source)
         self.ax_target = TargetWrapper(ax_target)
         self.edge = edge
-        Line2D.__init__(self, [], [], transform=None, clip_on=False, lw=1, zorder=100, linestyle="dashed",
-                        color="r", marker="o", ms=1, label="_tmp_snap")
-        plt.gca().add_artist(self)
+        self.line = np.zeros((0, 2))
+
+    def set_data(self, x, y=None):
+        if y is None:
+            x, y = x
+        self.line = np.column_stack((np.asarray(x, dtype=float), np.asarray(y, dtype=float)))
+
+    def getLines(self):
+        if len(self.line):
+            return [self.line]
+        return []
 
     def getPosition(self, axes):
         try:
@@ -242,10 +323,13 @@ class snapBase(Line2D):
 
     def checkSnap(self, index):
         distance = self.getDistance(index)
-        if abs(distance) < 10:
+        if abs(distance) < snap_distance:
             return distance
         return None
 
+    def getDistances(self):
+        return np.array([[self.getDistance(0), self.getDistance(1)]], dtype=float)
+
     def checkSnapActive(self):
         distance = min([self.getDistance(index) for index in [0, 1]])
         if abs(distance) < 1:
@@ -261,10 +345,6 @@ class snapBase(Line2D):
 
     def remove(self):
         self.hide()
-        # try:
-        #     self.axes.artists.remove(self)
-        # except ValueError:
-        #     pass
 
 
 class snapSameEdge(snapBase):
@@ -416,16 +496,326 @@ class snapCenterWith(snapBase):
 
 
 
+class SortedIndex:
+    """ values sorted in ascending order to find the ones within the snap distance with a binary search """
+
+    @staticmethod
+    def sort(values, indices=None):
+        if indices is None:
+            indices = np.arange(len(values))
+        order = np.argsort(values, kind="stable")
+        return values[order], indices[order]
+
+    @staticmethod
+    def query(sorted_values, value):
+        """ get the indices of the values that are within the snap distance of the value """
+        values, indices = sorted_values
+        start = np.searchsorted(values, value - snap_distance, side="left")
+        end = np.searchsorted(values, value + snap_distance, side="right")
+        return indices[start:end]
+
+
+class AxesIndex(SortedIndex):
+    """ the edges, sizes and gaps of the axes that targets can snap to, sorted to find the ones close to a value
+
+    The index is built once when a drag starts.
+    """
+
+    def __init__(self, axes):
+        self.axes = axes
+        if len(axes):
+            points = np.array([ax.get_position().get_points() for ax in axes])
+            self.extents = axes[0].figure.transFigure.transform(points.reshape(-1, 2)).reshape(-1, 4)
+        else:
+            self.extents = np.zeros((0, 4))
+        # the edges (left, bottom, right, top) and the sizes (width, height) in ascending order
+        self.edges = [self.sort(self.extents[:, edge]) for edge in range(4)]
+        self.sizes = [self.sort(self.extents[:, dim + 2] - self.extents[:, dim]) for dim in range(2)]
+        # the gaps between one axes and the other axes, only computed for the axes that are needed
+        self.gaps = {}
+
+    def getGaps(self, i):
+        """ the gaps between the axes i and the other axes that overlap with it in the other direction """
+        if i not in self.gaps:
+            p = self.extents[i]
+            values = []
+            indices = []
+            for dim in range(2):
+                other = 1 - dim
+                overlap = (self.extents[:, other + 2] >= p[other]) & (self.extents[:, other] <= p[other + 2])
+                overlap[i] = False
+                for gap in [self.extents[:, dim] - p[dim + 2], p[dim] - self.extents[:, dim + 2]]:
+                    mask = overlap & (gap > 0)
+                    values.append(gap[mask])
+                    indices.append(np.flatnonzero(mask))
+            self.gaps[i] = self.sort(np.concatenate(values), np.concatenate(indices))
+        return self.gaps[i]
+
+
+class snapIndexed:
+    """ all the snaps of a target to the axes of an AxesIndex
+
+    The distances to the axes whose edges, sizes or gaps are close to the ones of the target are computed as arrays,
+    snap objects are only created to display the active snaps.
+    """
+
+    def __init__(self, target, index, dir, no_height=False):
+        self.target = target
+        self.wrapper = TargetWrapper(target)
+        self.index = index
+        self.dir = dir
+        self.no_height = no_height
+        self.snaps = {}
+        self.keys = []
+        self.distances = np.zeros((0, 2))
+        self.distances_extent = None
+
+    def getSnap(self, key):
+        """ get the snap object to display the snap with the given key """
+        if key not in self.snaps:
+            kind, i, j = key
+            if kind == "edge":
+                self.snaps[key] = snapSameEdge(self.target, self.index.axes[i], j)
+            elif kind == "dimension":
+                self.snaps[key] = snapSameDimension(self.target, self.index.axes[i], j)
+            else:
+                self.snaps[key] = snapSameBorder(self.target, self.index.axes[i], self.index.axes[j], self.dir)
+        return self.snaps[key]
+
+    def getSourcePosition(self):
+        return np.array(self.wrapper.get_extent())
+
+    def getDistances(self):
+        """ get the x and y distances of the snaps that are close to the current position of the target
+
+        A snap that does not apply to a direction has an infinite distance in it, the keys of the snaps are stored in
+        self.keys.
+        """
+        p = self.getSourcePosition()
+        if self.distances_extent is not None and np.all(p == self.distances_extent):
+            return self.distances
+        self.keys, self.distances = self.computeDistances(p)
+        self.distances_extent = p
+        return self.distances
+
+    def computeDistances(self, p):
+        index = self.index
+        extents = index.extents
+        keys = []
+        distances = [np.zeros((0, 2))]
+
+        def add(kind, i, j, dim, values):
+            d = np.full((len(values), 2), np.inf)
+            d[:, dim] = values
+            distances.append(d)
+            keys.extend((kind, k, l) for k, l in zip(i, j))
+
+        for edge, direction in enumerate([DIR_X0, DIR_Y0, DIR_X1, DIR_Y1]):
+            if self.dir & direction:
+                i = index.query(index.edges[edge], p[edge])
+                add("edge", i, [edge] * len(i), edge % 2, p[edge] - extents[i, edge])
+        if not self.no_height:
+            for edge, direction in enumerate([DIR_X0, DIR_Y0, DIR_X1, DIR_Y1]):
+                if self.dir & direction:
+                    dim = edge % 2
+                    i = index.query(index.sizes[dim], p[dim + 2] - p[dim])
+                    add("dimension", i, [edge] * len(i), dim,
+                        (extents[i, edge - 2] - extents[i, edge]) - (p[edge - 2] - p[edge]))
+        # the axes next to the target with a gap that is similar to the gap to one of their neighbours
+        for dim in range(2):
+            other = 1 - dim
+            overlap = (extents[:, other + 2] >= p[other]) & (extents[:, other] <= p[other + 2])
+            # the target is before (left of or below) or after the axes
+            before = extents[:, dim] - p[dim + 2]
+            after = p[dim] - extents[:, dim + 2]
+            if not (self.dir & DIR_X1) and not (self.dir & DIR_Y1):
+                before[:] = -1
+            if not (self.dir & DIR_X0) and not (self.dir & DIR_Y0):
+                after[:] = -1
+            for i in np.flatnonzero(overlap & ((before > 0) | (after > 0))):
+                gap, sign = (before[i], -1) if before[i] > 0 else (after[i], 1)
+                gaps, j = index.getGaps(i)
+                selected = index.query((gaps, np.arange(len(gaps))), gap)
+                add("border", [i] * len(selected), j[selected], dim, (gap - gaps[selected]) * sign)
+        return keys, np.concatenate(distances)
+
+    def checkSnapActive(self):
+        distances = self.getDistances()
+        active = np.abs(np.min(distances, axis=1)) < 1
+        active_keys = set(key for key, is_active in zip(self.keys, active) if is_active)
+        for key in active_keys:
+            self.getSnap(key).checkSnapActive()
+        for key, snap in self.snaps.items():
+            if key not in active_keys:
+                snap.hide()
+
+    def getLines(self):
+        lines = []
+        for snap in self.snaps.values():
+            lines.extend(snap.getLines())
+        return lines
+
+    def remove(self):
+        for snap in self.snaps.values():
+            snap.remove()
+
+
+class TextIndex(SortedIndex):
+    """ the anchor positions of the texts that other texts can snap to, sorted in x and in y """
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.positions = np.array([txt.get_transform().transform(txt.get_position()) for txt in texts]).reshape(-1, 2)
+        self.coordinates = [self.sort(self.positions[:, dim]) for dim in range(2)]
+
+
+class snapTextIndexed(snapIndexed):
+    """ the snaps of the anchor of a text to the anchors of the texts in a TextIndex """
+
+    def __init__(self, target, index):
+        snapIndexed.__init__(self, target, index, 0)
+
+    def getSnap(self, key):
+        if key not in self.snaps:
+            kind, i, dim = key
+            self.snaps[key] = snapSamePos(self.target, self.index.texts[i], dim)
+        return self.snaps[key]
+
+    def getSourcePosition(self):
+        return np.array(self.target.get_transform().transform(self.target.get_position()))
+
+    def computeDistances(self, p):
+        keys = []
+        distances = [np.zeros((0, 2))]
+        for dim in range(2):
+            i = self.index.query(self.index.coordinates[dim], p[dim])
+            d = np.full((len(i), 2), np.inf)
+            d[:, dim] = p[dim] - self.index.positions[i, dim]
+            distances.append(d)
+            keys.extend(("pos", k, dim) for k in i)
+        return keys, np.concatenate(distances)
+
+
+class Guides:
+    """ a regular grid and user defined guide lines that the edges of the targets snap to
+
+    The grid spacing and the guide positions are given in "cm", "inch" or (any other unit) in figure coordinates,
+    negative guide positions are measured from the right or top edge of the figure. The positions are converted to
+    pixels once per drag, the closest grid line is then computed arithmetically and the closest guides with a binary
+    search.
+    """
+
+    def __init__(self, figure, grid=None, xguides=None, yguides=None, unit="cm"):
+        self.figure = figure
+        self.grid = grid
+        self.guides = [list(xguides or []), list(yguides or [])]
+        self.unit = unit
+        # the user defined guides are drawn as light gray lines behind the figure content
+        self.collection = LineCollection([], transform=figure.transFigure, linewidths=1, zorder=-10,
+                                         colors=[[0.8, 0.8, 0.8]], label="_tmp_snap")
+        figure.add_artist(self.collection)
+        self.update()
+
+    def toPixels(self, values, dim):
+        """ convert positions in the unit of the guides to display pixels """
+        values = np.asarray(values, dtype=float)
+        size = self.figure.bbox.size[dim]
+        if self.unit == "cm":
+            pixels = values / 2.54 * self.figure.dpi
+        elif self.unit == "inch":
+            pixels = values * self.figure.dpi
+        else:
+            pixels = values * size
+        return np.where(values < 0, size + pixels, pixels)
+
+    def update(self):
+        """ convert the grid and the guides to pixels for the current size and dpi of the figure """
+        self.pixels = [np.sort(self.toPixels(self.guides[dim], dim)) for dim in range(2)]
+        if self.grid:
+            self.grid_pixels = [float(self.toPixels(abs(self.grid), dim)) for dim in range(2)]
+        else:
+            self.grid_pixels = None
+        width, height = self.figure.bbox.size
+        segments = [[(x / width, 0), (x / width, 1)] for x in self.pixels[0]]
+        segments += [[(0, y / height), (1, y / height)] for y in self.pixels[1]]
+        self.collection.set_segments(segments)
+
+    def set_grid(self, grid, unit=None):
+        if unit is not None:
+            self.unit = unit
+        self.grid = grid
+        self.update()
+
+    def set_guides(self, xguides=None, yguides=None, unit=None):
+        if unit is not None:
+            self.unit = unit
+        self.guides = [list(xguides or []), list(yguides or [])]
+        self.update()
+
+    def getClosestLines(self, dim, value):
+        """ get the position of the closest grid line and the closest guides to a pixel value in the direction dim """
+        lines = []
+        if self.grid_pixels is not None:
+            lines.append(np.round(value / self.grid_pixels[dim]) * self.grid_pixels[dim])
+        pixels = self.pixels[dim]
+        i = np.searchsorted(pixels, value)
+        lines.extend(pixels[max(i - 1, 0):i + 1])
+        return lines
+
+    def getLine(self, dim, position):
+        """ the line of a grid line or a guide across the figure in display coordinates """
+        size = self.figure.bbox.size[1 - dim]
+        if dim == 0:
+            return np.array([[position, 0], [position, size]])
+        return np.array([[0, position], [size, position]])
+
+
+class snapGuides:
+    """ the snaps of the edges of a target to the grid and the guides, the active ones are drawn by the SnapOverlay """
+
+    def __init__(self, target, guides, dir):
+        self.wrapper = TargetWrapper(target)
+        self.guides = guides
+        self.dir = dir
+        self.keys = []
+        self.lines = []
+
+    def getDistances(self):
+        p = np.array(self.wrapper.get_extent())
+        self.keys = []
+        distances = []
+        for edge, direction in enumerate([DIR_X0, DIR_Y0, DIR_X1, DIR_Y1]):
+            if self.dir & direction:
+                dim = edge % 2
+                for position in self.guides.getClosestLines(dim, p[edge]):
+                    d = [np.inf, np.inf]
+                    d[dim] = p[edge] - position
+                    distances.append(d)
+                    self.keys.append((dim, position))
+        return np.array(distances, dtype=float).reshape(-1, 2)
+
+    def checkSnapActive(self):
+        distances = self.getDistances()
+        active_keys = set(key for key, d in zip(self.keys, distances) if abs(d[key[0]]) < 1)
+        self.lines = [self.guides.getLine(dim, position) for dim, position in active_keys]
+
+    def getLines(self):
+        return self.lines
+
+    def remove(self):
+        self.lines = []
+
+
 def checkSnaps(snaps):
+    """ get the offset in x and y to the closest snap within the snap distance """
     result = [0, 0]
+    if len(snaps) == 0:
+        return result
+    distances = np.concatenate([snap.getDistances() for snap in snaps])
     for index in range(2):
-        best = np.inf
-        for snap in snaps:
-            delta = snap.checkSnap(index)
-            if delta is not None and abs(delta) < abs(best):
-                best = delta
-        if best < np.inf:
-            result[index] = best
+        valid = np.flatnonzero(np.abs(distances[:, index]) < snap_distance)
+        if len(valid):
+            result[index] = distances[valid[np.argmin(np.abs(distances[valid, index]))], index]
     return result
 
 
@@ -434,53 +824,34 @@ def checkSnapsActive(snaps):
         snap.checkSnapActive()
 
 
-def getSnaps(targets, dir, no_height=False):
+def getSnaps(targets, dir, no_height=False, guides=None):
     snaps = []
+    if guides is not None:
+        guides.update()
+    axes_index = None
+    text_index = None
     targets = [t.target for t in targets]
     #if isinstance(target, TargetWrapper):
     #    target = target.target
     for target in targets:
         if isinstance(target, Legend):
             continue
+        if guides is not None:
+            snaps.append(snapGuides(target, guides, dir))
         if isinstance(target, Text):
             if checkXLabel(target):
                 snaps.append(snapCenterWith(target, checkXLabel(target), 0))
             elif checkYLabel(target):
                 snaps.append(snapCenterWith(target, checkYLabel(target), 1))
-            for ax in target.figure.axes + [target.figure]:
-                for txt in ax.texts:
-                    # for other texts
-                    if txt in targets or not txt.get_visible():
-                        continue
-                    # snap to the x and the y coordinate
-                    x, y = txt.get_transform().transform(txt.get_position())
-                    snaps.append(snapSamePos(target, txt, 0))
-                    snaps.append(snapSamePos(target, txt, 1))
+            # the anchors of the other texts are indexed once for all targets
+            if text_index is None:
+                text_index = TextIndex([txt for ax in target.figure.axes + [target.figure] for txt in ax.texts
+                                        if txt not in targets and txt.get_visible()])
+            # snap to the x and the y coordinate
+            snaps.append(snapTextIndexed(target, text_index))
             continue
-        for index, axes in enumerate(target.figure.axes):
-            if axes not in targets and axes.get_visible():
-                # axes edged
-                if dir & DIR_X0:
-                    snaps.append(snapSameEdge(target, axes, 0))
-                if dir & DIR_Y0:
-                    snaps.append(snapSameEdge(target, axes, 1))
-                if dir & DIR_X1:
-                    snaps.append(snapSameEdge(target, axes, 2))
-                if dir & DIR_Y1:
-                    snaps.append(snapSameEdge(target, axes, 3))
-
-                # snap same dimensions
-                if not no_height:
-                    if dir & DIR_X0:
-                        snaps.append(snapSameDimension(target, axes, 0))
-                    if dir & DIR_X1:
-                        snaps.append(snapSameDimension(target, axes, 2))
-                    if dir & DIR_Y0:
-                        snaps.append(snapSameDimension(target, axes, 1))
-                    if dir & DIR_Y1:
-                        snaps.append(snapSameDimension(target, axes, 3))
-
-                for axes2 in target.figure.axes:
-                    if axes2 != axes and axes2 not in targets and axes2.get_visible():
-                        snaps.append(snapSameBorder(target, axes, axes2, dir))
+        # the edges of the other axes are indexed once for all targets
+        if axes_index is None:
+            axes_index = AxesIndex([axes for axes in target.figure.axes if axes not in targets and axes.get_visible()])
+        snaps.append(snapIndexed(target, axes_index, dir, no_height=no_height))
     return snaps